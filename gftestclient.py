@@ -1,11 +1,70 @@
 """ Getfile Test Client for Abnormal Cases """
+import asyncio
+import collections
+import errno
+import hashlib
+import multiprocessing
+import random
+import resource
+import selectors
 import socket
+import threading
 import time
 import sys
 
 # Hello, OMSCS 6200 GIOS Spring 2022!
 # By: Miguel Paraz <mparaz@gatech.edu>
 
+SERVER_ADDRESS = ("127.0.0.1", 47293)
+
+# Request shapes for the load mode, taken from the single request options.
+LOAD_REQUESTS = {
+    "valid": [
+        b"GETFILE GET /hello\r\n\r\n",
+    ],
+    "corpus": [
+        b"GETFILE GET /courses/ud923/filecorpus/s1kb.png\r\n\r\n",
+        b"GETFILE GET /courses/ud923/filecorpus/road.jpg\r\n\r\n",
+    ],
+    "malformed": [
+        b"GETFILE  GET /hello",
+        b"GETFILE GET /hello\r\nX\r\n",
+        b"GETFIL GET /hello\r\n\r\n",
+        b"GETFILE GETZ /hello\r\n\r\n",
+        b"GETFILE PUT /foo.jpg\r\n\r\n",
+        b"GETFILE GET foo.jpg\r\n\r\n",
+    ],
+}
+LOAD_REQUESTS["mixed"] = [request for requests in LOAD_REQUESTS.values() for request in requests]
+
+# A request that gets no complete response in this time counts as TIMEOUT.
+LOAD_REQUEST_TIMEOUT = 5
+
+# Receive buffer for the streaming response reader, allocated once per response.
+RECV_BUFFER_SIZE = 1 << 20
+
+# Give up on a header that has not ended after this many bytes.
+MAX_HEADER_SIZE = 8192
+
+# Connection churn, as in options 13, 12 and 11: what to send before closing.
+CHURN_REQUESTS = {
+    "close": b"",
+    "partial": b"GETFILE GET ",
+    "full": b"GETFILE GET /courses/ud923/filecorpus/road.jpg\r\n\r\n",
+}
+
+# Slow drip, as in options 7 and 17: the request sent one byte at a time.
+DRIP_REQUEST = b"GETFILE GET /hello\r\n\r\n"
+DRIP_WHEEL_TICK = 0.01
+# Time between probe requests, while the drips run.
+PROBE_INTERVAL = 0.5
+
+# TCP state number for TIME_WAIT in /proc/net/tcp.
+TCP_TIME_WAIT = "06"
+
+GetfileResponse = collections.namedtuple(
+    "GetfileResponse", "status length received sha1 ttfb elapsed")
+
 def send_to_server(buf):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect(("127.0.0.1", 47293))
@@ -15,6 +74,394 @@ def send_to_server(buf):
     s.close()
 
 
+class LatencyHistogram:
+    """ HDR-style latency histogram: microsecond values kept to two significant digits. """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        value = int(seconds * 1_000_000)
+        # Drop everything past the second significant digit, so buckets grow with the value.
+        magnitude = 10 ** max(0, len(str(value)) - 2)
+        self.counts[value // magnitude * magnitude] += 1
+        self.total += 1
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """ Lowest bucket covering percent of the values, in microseconds. """
+        threshold = self.total * percent / 100
+        count = 0
+        for value in sorted(self.counts):
+            count += self.counts[value]
+            if count >= threshold:
+                return value
+        return self.max
+
+
+def response_status(response):
+    """ Status word of a GETFILE response header, e.g. OK or FILE_NOT_FOUND. """
+    entries = response.split(b"\r\n", 1)[0].split(b" ")
+    if len(entries) >= 2 and entries[0] == b"GETFILE":
+        return entries[1].decode(errors="replace")
+    return "MALFORMED" if response else "EMPTY"
+
+
+def read_response(s):
+    """ Read a GETFILE response, hashing the payload as it arrives, in constant memory. """
+    buffer = bytearray(RECV_BUFFER_SIZE)
+    view = memoryview(buffer)
+    header = bytearray()
+    hash = hashlib.sha1()
+    status = "EMPTY"
+    length = None
+    received = 0
+    ttfb = None
+
+    start_time = time.perf_counter()
+    while length is None or received < length:
+        n = s.recv_into(buffer)
+        if not n:
+            break
+        if ttfb is None:
+            ttfb = time.perf_counter() - start_time
+
+        if length is not None:
+            # Only hash up to the advertised length, in case the server sends more.
+            chunk = view[:min(n, length - received)]
+            hash.update(chunk)
+            received += len(chunk)
+            continue
+
+        # The header may be split anywhere, only search the part that could hold a new terminator.
+        search_start = max(0, len(header) - 3)
+        header += view[:n]
+        end = header.find(b"\r\n\r\n", search_start)
+        if end < 0:
+            status = "MALFORMED"
+            if len(header) > MAX_HEADER_SIZE:
+                break
+            continue
+
+        status = response_status(bytes(header[:end]) + b"\r\n")
+        entries = header[:end].split(b" ")
+        if status != "OK":
+            break
+        if len(entries) != 3 or not entries[2].isdigit():
+            status = "MALFORMED"
+            break
+        length = int(entries[2])
+        chunk = header[end + 4:end + 4 + length]
+        hash.update(chunk)
+        received = len(chunk)
+
+    return GetfileResponse(status, length, received, hash.hexdigest(), ttfb, time.perf_counter() - start_time)
+
+
+def get_file(path, expected_sha1=None):
+    """ Request one file, check its length and optionally its SHA1, and show the transfer rate. """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect(SERVER_ADDRESS)
+    s.sendall(bytes(f"GETFILE GET {path}\r\n\r\n", "UTF-8"))
+    response = read_response(s)
+    s.close()
+
+    ttfb = f"{1000 * response.ttfb:0.3f}ms" if response.ttfb is not None else "none"
+    print(
+        f"status={response.status}, length={response.length}, received={response.received}, "
+        f"sha1sum={response.sha1}, ttfb={ttfb}, elapsed={response.elapsed:0.3f}s, "
+        f"{response.received / response.elapsed / 1e6:0.2f} MB/s"
+    )
+    if response.length is not None and response.received != response.length:
+        print(f"Short payload: {response.received} of {response.length} bytes")
+    if expected_sha1:
+        print("SHA1 matches" if response.sha1 == expected_sha1 else f"SHA1 mismatch, expected {expected_sha1}")
+    return response
+
+
+def churn_worker(kind, duration, rate):
+    """ Open and close connections for duration seconds, at rate per second or as fast as possible. """
+    request = CHURN_REQUESTS[kind]
+    outcomes = collections.Counter()
+    histogram = LatencyHistogram()
+    interval = 1 / rate if rate else 0
+    start_time = time.perf_counter()
+    next_time = start_time
+    while time.perf_counter() - start_time < duration:
+        if interval:
+            next_time += interval
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            connect_time = time.perf_counter()
+            s.connect(SERVER_ADDRESS)
+            histogram.record(time.perf_counter() - connect_time)
+            if request:
+                s.sendall(request)
+            outcomes["OK"] += 1
+        except OSError as e:
+            # EADDRNOTAVAIL here means the ephemeral ports are used up, usually by TIME_WAIT.
+            outcomes[errno.errorcode.get(e.errno, type(e).__name__)] += 1
+        finally:
+            s.close()
+    return outcomes, histogram
+
+
+class TimerWheel:
+    """ Hashed timer wheel: scheduling is O(1), and each tick only visits one slot. """
+
+    def __init__(self, tick, max_delay):
+        self.tick = tick
+        self.slots = [[] for _ in range(int(max_delay / tick) + 2)]
+        self.current = 0
+        self.time = time.monotonic()
+
+    def schedule(self, delay, item):
+        ticks = min(max(1, round(delay / self.tick)), len(self.slots) - 1)
+        self.slots[(self.current + ticks) % len(self.slots)].append(item)
+
+    def expired(self):
+        """ Advance to now, returning the items of every slot passed. """
+        items = []
+        now = time.monotonic()
+        while self.time + self.tick <= now:
+            self.time += self.tick
+            self.current = (self.current + 1) % len(self.slots)
+            items += self.slots[self.current]
+            self.slots[self.current] = []
+        return items
+
+
+class DripConnection:
+    """ One non-blocking connection sending DRIP_REQUEST a byte at a time. """
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.position = 0
+        self.connected = False
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.s.setblocking(False)
+        self.s.connect_ex(SERVER_ADDRESS)
+        selector.register(self.s, selectors.EVENT_WRITE, self)
+
+    def close(self):
+        self.selector.unregister(self.s)
+        self.s.close()
+        self.s = None
+
+
+def probe(stop, active, histogram, path):
+    """ Keep sending normal requests while the drips run, showing when the server stops answering. """
+    start_time = time.monotonic()
+    while not stop.is_set():
+        request_time = time.perf_counter()
+        try:
+            s = socket.create_connection(SERVER_ADDRESS, timeout=LOAD_REQUEST_TIMEOUT)
+            s.sendall(bytes(f"GETFILE GET {path}\r\n\r\n", "UTF-8"))
+            status = read_response(s).status
+            s.close()
+        except OSError as e:
+            status = "TIMEOUT" if isinstance(e, socket.timeout) else errno.errorcode.get(e.errno, type(e).__name__)
+        latency = time.perf_counter() - request_time
+        histogram.record(latency)
+        print(f"probe t={time.monotonic() - start_time:0.1f}s drips={active[0]} status={status} latency={1000 * latency:0.3f}ms")
+        stop.wait(PROBE_INTERVAL)
+
+
+def run_drip(connections, delay, duration, path):
+    """ Hold connections slow-drip requests open from one thread, while a probe measures the server. """
+    # Thousands of connections need thousands of descriptors.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    selector = selectors.DefaultSelector()
+    wheel = TimerWheel(DRIP_WHEEL_TICK, delay)
+    outcomes = collections.Counter()
+    active = [0]
+
+    stop = threading.Event()
+    histogram = LatencyHistogram()
+    probe_thread = threading.Thread(target=probe, args=(stop, active, histogram, path))
+    probe_thread.start()
+
+    drips = [DripConnection(selector) for _ in range(connections)]
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for key, mask in selector.select(DRIP_WHEEL_TICK):
+            drip = key.data
+            if not drip.connected:
+                error = drip.s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    outcomes[errno.errorcode.get(error, str(error))] += 1
+                    drip.close()
+                    # Reconnect after a delay, so a server that is down is not flooded with connects.
+                    wheel.schedule(delay, None)
+                    continue
+                drip.connected = True
+                active[0] += 1
+                selector.modify(drip.s, selectors.EVENT_READ, drip)
+                wheel.schedule(delay, drip)
+            else:
+                # Any response, or a close, ends this drip. Start another like option 17, after a delay.
+                try:
+                    data = drip.s.recv(8192)
+                except OSError as e:
+                    data = None
+                    outcomes[errno.errorcode.get(e.errno, type(e).__name__)] += 1
+                outcomes["response" if data else "closed by server"] += 1
+                active[0] -= 1
+                drip.close()
+                wheel.schedule(delay, None)
+
+        for drip in wheel.expired():
+            # None is a connection to replace one that ended.
+            if drip is None:
+                drips.append(DripConnection(selector))
+                continue
+            if drip.s is None:
+                continue
+            try:
+                drip.s.send(DRIP_REQUEST[drip.position:drip.position + 1])
+            except OSError as e:
+                outcomes[errno.errorcode.get(e.errno, type(e).__name__)] += 1
+                continue
+            drip.position += 1
+            if drip.position < len(DRIP_REQUEST):
+                wheel.schedule(delay, drip)
+            else:
+                outcomes["request sent"] += 1
+
+        # Forget the closed connections now and then.
+        if len(drips) > 2 * connections:
+            drips = [drip for drip in drips if drip.s is not None]
+
+    stop.set()
+    probe_thread.join()
+    for drip in drips:
+        if drip.s is not None:
+            drip.close()
+
+    print(f"drips: {dict(outcomes)}")
+    print(
+        f"probe: {histogram.total} requests, latency us p50={histogram.percentile(50)} "
+        f"p90={histogram.percentile(90)} p99={histogram.percentile(99)} max={histogram.max}"
+    )
+
+
+def count_time_wait(port):
+    """ Count TIME_WAIT sockets to or from port. """
+    count = 0
+    for filename in ["/proc/net/tcp", "/proc/net/tcp6"]:
+        try:
+            with open(filename, "r") as file:
+                next(file)
+                for line in file:
+                    entries = line.split()
+                    local_port = int(entries[1].rsplit(":", 1)[1], 16)
+                    remote_port = int(entries[2].rsplit(":", 1)[1], 16)
+                    if entries[3] == TCP_TIME_WAIT and port in (local_port, remote_port):
+                        count += 1
+        except FileNotFoundError:
+            pass
+    return count
+
+
+def run_churn(kind, processes, duration, rate):
+    """ Churn connections from several processes and report the accept-path throughput. """
+    with open("/proc/sys/net/ipv4/ip_local_port_range", "r") as file:
+        low, high = (int(entry) for entry in file.read().split())
+    print(f"TIME_WAIT before: {count_time_wait(SERVER_ADDRESS[1])}, ephemeral ports: {high - low + 1}")
+
+    outcomes = collections.Counter()
+    histogram = LatencyHistogram()
+    start_time = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        for process_outcomes, process_histogram in pool.starmap(
+                churn_worker, [(kind, duration, rate / processes)] * processes):
+            outcomes.update(process_outcomes)
+            histogram.merge(process_histogram)
+    elapsed_time = time.perf_counter() - start_time
+
+    time_wait = count_time_wait(SERVER_ADDRESS[1])
+    print(
+        f"{kind}: {outcomes['OK']} connections in {elapsed_time:0.2f}s, {outcomes['OK'] / elapsed_time:0.2f} connections/s, "
+        f"connect latency us p50={histogram.percentile(50)} p90={histogram.percentile(90)} "
+        f"p99={histogram.percentile(99)} max={histogram.max}"
+    )
+    print(f"Errors: {dict(outcomes - collections.Counter(OK=outcomes['OK']))}")
+    print(f"TIME_WAIT after: {time_wait}")
+    if time_wait > (high - low + 1) * 0.8:
+        print("XXX warning, TIME_WAIT is close to the ephemeral port range, connects will start to fail XXX")
+
+
+async def load_request(request):
+    """ Send one request and read until the server closes. Return (status, bytes received). """
+    reader, writer = await asyncio.open_connection(*SERVER_ADDRESS)
+    try:
+        writer.write(request)
+        head = b""
+        nbytes = 0
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return response_status(head), nbytes
+            if len(head) < 64:
+                head += data[:64]
+            nbytes += len(data)
+    finally:
+        writer.close()
+
+
+async def load_worker(requests, deadline, remaining, histograms, nbytes):
+    while time.perf_counter() < deadline and remaining[0] != 0:
+        remaining[0] -= 1
+        start_time = time.perf_counter()
+        try:
+            status, received = await asyncio.wait_for(load_request(random.choice(requests)), LOAD_REQUEST_TIMEOUT)
+            nbytes[0] += received
+        except asyncio.TimeoutError:
+            status = "TIMEOUT"
+        except OSError as e:
+            status = type(e).__name__
+        histograms[status].record(time.perf_counter() - start_time)
+
+
+async def run_load(connections, duration, request_count, shape):
+    """ Keep connections requests in flight until duration seconds pass or request_count are sent. """
+    # Thousands of connections need thousands of descriptors.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    histograms = collections.defaultdict(LatencyHistogram)
+    remaining = [request_count]
+    nbytes = [0]
+    start_time = time.perf_counter()
+    await asyncio.gather(*[
+        load_worker(LOAD_REQUESTS[shape], start_time + duration, remaining, histograms, nbytes)
+        for _ in range(connections)
+    ])
+    elapsed_time = time.perf_counter() - start_time
+
+    total = sum(histogram.total for histogram in histograms.values())
+    print(f"{total} requests in {elapsed_time:0.2f}s, {total / elapsed_time:0.2f} rps, {nbytes[0] / elapsed_time:0.0f} bytes/s")
+    for status, histogram in sorted(histograms.items()):
+        print(
+            f"{status}: {histogram.total} requests, latency us "
+            f"p50={histogram.percentile(50)} p90={histogram.percentile(90)} "
+            f"p99={histogram.percentile(99)} max={histogram.max}"
+        )
+
+
 if __name__ == "__main__":
     option = int(sys.argv[1]) if len(sys.argv)>1 else 2
     print(f"option={option}")
@@ -143,6 +590,46 @@ if __name__ == "__main__":
             print(s.recv(8192))
             s.close()
 
+    elif option == 100:
+        # Option 100. Load test: keep many connections busy, then report throughput and latency.
+        # Arguments: connections, duration like 10s or a request count like 5000, and the
+        # request shape: valid, corpus, malformed or mixed.
+        connections = int(sys.argv[2]) if len(sys.argv)>2 else 100
+        limit = sys.argv[3] if len(sys.argv)>3 else "10s"
+        shape = sys.argv[4] if len(sys.argv)>4 else "mixed"
+        if limit.endswith("s"):
+            duration, request_count = float(limit[:-1]), -1
+        else:
+            duration, request_count = float("inf"), int(limit)
+        asyncio.run(run_load(connections, duration, request_count, shape))
+
+    elif option == 101:
+        # Option 101. Download one file with header parsing, and check the SHA1 printed by the server.
+        # Arguments: path, and optionally the expected SHA1, e.g. from gftestserver option 1001 or 1002.
+        path = sys.argv[2] if len(sys.argv)>2 else "/courses/ud923/filecorpus/road.jpg"
+        expected_sha1 = sys.argv[3] if len(sys.argv)>3 else None
+        get_file(path, expected_sha1)
+
+    elif option == 102:
+        # Option 102. Connection churn: open and close connections as fast as possible, or at a rate.
+        # Arguments: close, partial or full (like options 13, 12 and 11), processes,
+        # duration in seconds, and the total target connections per second, 0 for as fast as possible.
+        kind = sys.argv[2] if len(sys.argv)>2 else "close"
+        processes = int(sys.argv[3]) if len(sys.argv)>3 else multiprocessing.cpu_count()
+        duration = float(sys.argv[4]) if len(sys.argv)>4 else 10
+        rate = float(sys.argv[5]) if len(sys.argv)>5 else 0
+        run_churn(kind, processes, duration, rate)
+
+    elif option == 103:
+        # Option 103. Many slow-drip requests at once (options 7 and 17 at scale), with a probe
+        # request every half second to show when the server stops answering.
+        # Arguments: connections, delay between bytes in seconds, duration in seconds, probe path.
+        connections = int(sys.argv[2]) if len(sys.argv)>2 else 1000
+        delay = float(sys.argv[3]) if len(sys.argv)>3 else 1
+        duration = float(sys.argv[4]) if len(sys.argv)>4 else 30
+        path = sys.argv[5] if len(sys.argv)>5 else "/hello"
+        run_drip(connections, delay, duration, path)
+
     elif option == 0:
         print("# Option 1. Send an complete request./hello\r\n\r\n")
         time.sleep(0.1)
@@ -1,172 +1,464 @@
 """ Getfile Test Server for Abnormal Cases """
+import asyncio
+import collections
+import concurrent.futures
+import functools
 import socket
+import threading
 import time
 import random
+import re
 import hashlib
+import os
+import resource
 import sys
-import importlib.util
 
 # Hello, OMSCS 6200 GIOS Spring 2022!
 # By: Miguel Paraz <mparaz@gatech.edu>
 
-# Use optimised random function if available
-# Thanks to Vladimir.
-def slow_random_bytes(buffer_size):
-    return bytes([random.randint(0, 255) for _ in range(0, buffer_size)])
+HOST = "127.0.0.1"
+PORT = 47293
 
-random_bytes = None
+# Default listen() backlog, override on the command line for many concurrent clients.
+DEFAULT_BACKLOG = 5
 
-if importlib.util.find_spec("numpy"):
-    print("numpy found")
-    import numpy as np
-    random_bytes = np.random.bytes
-else:
-    print("numpy not found, consider: pip install numpy")
-    random_bytes = slow_random_bytes
+# Option 2000 serves real files from the content.txt written by gfworkload.py.
+CONTENT_OPTION = 2000
+DEFAULT_CONTENT_FILENAME = "content.txt"
+DEFAULT_CONTENT_WORKERS = 64
+FILE_CACHE_CAPACITY = 1024
 
-if __name__ == "__main__":
+# Unix PATH_MAX plus the scheme, method and terminator.
+MAX_REQUEST_SIZE = 4096 + 64
+REQUEST_RE = re.compile(rb"GETFILE GET (/[^ \r\n]*)\r\n\r\n")
 
+# Seconds a client may take to send its request, so an idle one does not hold a worker forever.
+REQUEST_TIMEOUT = 10
 
-    # Which option to test
-    option = int(sys.argv[1]) if len(sys.argv)>1 else 1
-    print(f"option={option}")
-    
+# All random content is carved out of one pool, generated once.
+# Chunks are zero-copy slices at random offsets, so no per-byte Python work and no numpy needed.
+# Thanks to Vladimir for the original numpy speedup.
+RANDOM_POOL_SIZE = 4 << 20
+
+random_pool = memoryview(os.urandom(RANDOM_POOL_SIZE))
+
+
+def random_bytes(buffer_size):
+    """ Return buffer_size random bytes, as a slice of the pool when it fits. """
+    if buffer_size > RANDOM_POOL_SIZE:
+        full_pools, remaining = divmod(buffer_size, RANDOM_POOL_SIZE)
+        return b"".join([random_pool] * full_pools + [random_bytes(remaining)])
+    offset = random.randint(0, RANDOM_POOL_SIZE - buffer_size)
+    return random_pool[offset:offset + buffer_size]
+
+
+# Yielded by responses() to close the connection right away.
+CLOSE = object()
+
+# Option 1002 sends one seeded block over and over, so the SHA1 is known before sending.
+STREAM_SEED = 6200
+STREAM_BLOCK_SIZE = 1 << 20
+
+
+@functools.lru_cache(maxsize=None)
+def stream_payload(size, seed=STREAM_SEED, block_size=STREAM_BLOCK_SIZE):
+    """ Build the repeated block for a size byte stream, and the SHA1 of the whole stream. """
+    block = memoryview(random.Random(seed).randbytes(block_size))
+    hash = hashlib.sha1()
+    full_blocks, remaining = divmod(size, block_size)
+    for _ in range(full_blocks):
+        hash.update(block)
+    hash.update(block[:remaining])
+    return block, hash.hexdigest()
+
+
+def stream_chunks(block, size):
+    """ Yield zero-copy slices of block until size bytes are covered. """
+    while size > 0:
+        chunk = block[:size]
+        yield chunk
+        size -= len(chunk)
+
+
+
+def responses(option):
+    """ Generate the response for an option.
+
+    Yields bytes to send, a number of seconds to wait, or CLOSE.
+    The same generator drives the serial and the concurrent servers,
+    so both put exactly the same bytes on the wire.
+    """
+    if option == 1:
+        # Option 1.  # Do not send anything.
+        # Break this server and the client recv() may ECONNRESET if it is waiting for data.
+        pass
+    elif option == 2:
+        # Option 2. Send the header, in two pieces. Then send 1 byte payload. Client should succeed.
+        yield b"GETFILE OK "
+        yield 1
+        yield b"1\r\n\r\nX"
+    elif option == 3:
+        # Option 3. Send the header, in pieces, with enough time to interrupt. Then send 1 byte payload.
+        # Break this server to cause ECONNRESET on the client recv() in the header processing.
+        yield b"GETFILE OK "
+        yield 3600
+        yield b"1\r\n\r\nX"
+    elif option == 4:
+        # Option 4. Send rubbish payload, slowly. Break this server to cause ECONNRESET on the client recv()
+        # in the payload processing.
+        yield b"GETFILE OK 123456789\r\n\r\n"
+        while True:
+            yield b"abcd"
+            yield 1
+    elif option == 5:
+        # Option 5. Send a non-decimal length
+        yield b"GETFILE OK badlengthisbad\r\n\r\n"
+    elif option == 6:
+        # Option 6. Send a bad character in the middle of the CR LF
+        yield b"GETFILE OK 123\r\n!\r\n"
+    elif option == 7:
+        # Option 7. Send a file containing CR LF
+        yield b"GETFILE OK 2\r\n\r\n\r\n"
+    elif option == 8:
+        # Option 8. Send a file containing CR LF CR LF
+        yield b"GETFILE OK 4\r\n\r\n\r\n\r\n"
+    elif option == 9:
+        # Option 9. Send incomplete header and close the connection
+        yield b"GETFILE OK 5\r\n\r"
+        yield CLOSE
+    elif option == 10:
+        # Option 10. Send FILE_NOT_FOUND status.
+        yield b"GETFILE FILE_NOT_FOUND\r\n\r\n"
+    elif option == 11:
+        # Option 11. Send ERROR status.
+        yield b"GETFILE ERROR\r\n\r\n"
+    elif option == 12:
+        # Option 12. Send INVALID status.
+        yield b"GETFILE INVALID\r\n\r\n"
+    elif option == 13:
+        # Option 13. Send wrong scheme.
+        yield b"POSTFILE OK 4\r\n\r\nabcd"
+    elif option == 14:
+        # Option 14. Send status not in set.
+        yield b"GETFILE WRONG\r\n\r\n"
+    elif option == 1000:
+        # Serve a 2 GB + extra_bytes (exceeds int) file
+        # This can be verified with: sha1sum filename.
+        hash = hashlib.sha1()
+        extra_bytes = 1
+        orig_size = 2**31 + extra_bytes
+        size = orig_size
+        buffer_size = 8192
+
+        yield bytes(f"GETFILE OK {size}\r\n\r\n", "UTF-8")
+        while size > extra_bytes:
+            random_buffer = random_bytes(buffer_size)
+            hash.update(random_buffer)
+            yield random_buffer
+            size -= buffer_size
+        last_buffer = random_bytes(size)
+        hash.update(last_buffer)
+        yield last_buffer
+
+        print('XXX warning, sha1sum does not match files XXX')
+        print(f"size={orig_size}, sha1sum={hash.hexdigest()}")
+    elif option == 1002:
+        # Serve the same 2 GB + 1 byte size as option 1000, fast enough to measure the client.
+        # The payload is built and hashed once, then sent as slices of one buffer.
+        # This can be verified with: sha1sum filename.
+        size = 2**31 + 1
+        block, sha1sum = stream_payload(size)
+        print(f"size={size}, sha1sum={sha1sum}")
+
+        yield bytes(f"GETFILE OK {size}\r\n\r\n", "UTF-8")
+        yield from stream_chunks(block, size)
+    elif option == 1001:
+        # Serve a random sized file with random-sized buffers of random bytes, and show the SHA1 hash.
+        # This can be verified with: sha1sum filename.
+        #
+        # header is part of the buffer.
+        hash = hashlib.sha1()
+        orig_size = random.randint(10_000, 1_000_000)
+        size = orig_size
+
+        header_buffer = bytes(f"GETFILE OK {size}\r\n\r\n", "UTF-8")
+        header_buffer_size = len(header_buffer)
+
+        payload_size = random.randint(min(100, size), min(1_000, size))
+        random_payload = random_bytes(payload_size)
+
+        first_buffer = header_buffer + random_payload
+        first_buffer_size = len(first_buffer)
+
+        print(f"header size {header_buffer_size} + payload size {payload_size} = first buffer size {first_buffer_size}")
+
+        # Hash only includes the payload, as the header is not stored on the client.
+        hash.update(random_payload)
+        yield first_buffer
+
+        # Size to send only includes the payload, not the header.
+        size -= payload_size
+        print(f"remaining size {size}")
+
+        while size > 0:
+            buffer_size = random.randint(min(100, size), min(1_000, size))
+            random_buffer = random_bytes(buffer_size)
+            hash.update(random_buffer)
+            yield random_buffer
+            size -= buffer_size
+
+        print(f"size={orig_size}, sha1sum={hash.hexdigest()}")
+    else:
+        # Serve a random sized file with random-sized buffers of random bytes, and show the SHA1 hash.
+        # This can be verified with: sha1sum filename.
+        #
+        # header is not part of the buffer.
+        hash = hashlib.sha1()
+        orig_size = random.randint(10_000, 1_000_000)
+        size = orig_size
+
+        yield bytes(f"GETFILE OK {size}\r\n\r\n", "UTF-8")
+        while size > 0:
+            buffer_size = random.randint(min(100, size), min(1_000, size))
+            random_buffer = random_bytes(buffer_size)
+            hash.update(random_buffer)
+            yield random_buffer
+            size -= buffer_size
+
+        print(f"size={orig_size}, sha1sum={hash.hexdigest()}")
+
+
+def serve_serial(option, backlog):
+    """ One connection at a time, the original behaviour. """
     ss = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     ss.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    ss.bind(("127.0.0.1", 47293))
-    ss.listen(5)
+    ss.bind((HOST, PORT))
+    ss.listen(backlog)
 
     while True:
+        # The previous connection is only closed here, when s is rebound.
         s, t = ss.accept()
 
         # Receive and show the header, don't do anything with it
         print(s.recv(8192))
-        
-        if option == 1:
-            # Option 1.  # Do not send anything.
-            # Break this server and the client recv() may ECONNRESET if it is waiting for data.
-            pass
-        elif option == 2:
-            # Option 2. Send the header, in two pieces. Then send 1 byte payload. Client should succeed.
-            s.send(b"GETFILE OK ")
-            time.sleep(1)
-            s.send(b"1\r\n\r\nX")
-        elif option == 3:
-            # Option 3. Send the header, in pieces, with enough time to interrupt. Then send 1 byte payload.
-            # Break this server to cause ECONNRESET on the client recv() in the header processing.
-            s.send(b"GETFILE OK ")
-            time.sleep(3600)
-            s.send(b"1\r\n\r\nX")
-        elif option == 4:
-            # Option 4. Send rubbish payload, slowly. Break this server to cause ECONNRESET on the client recv()
-            # in the payload processing.
-            s.send(b"GETFILE OK 123456789\r\n\r\n")
-            while True:
-                s.send(b"abcd")
-                time.sleep(1)
-        elif option == 5:
-            # Option 5. Send a non-decimal length
-            s.send(b"GETFILE OK badlengthisbad\r\n\r\n")
-        elif option == 6:
-            # Option 6. Send a bad character in the middle of the CR LF
-            s.send(b"GETFILE OK 123\r\n!\r\n")
-        elif option == 7:
-            # Option 7. Send a file containing CR LF
-            s.send(b"GETFILE OK 2\r\n\r\n\r\n")
-        elif option == 8:
-            # Option 8. Send a file containing CR LF CR LF
-            s.send(b"GETFILE OK 4\r\n\r\n\r\n\r\n")
-        elif option == 9:
-            # Option 9. Send incomplete header and close the connection
-            s.send(b"GETFILE OK 5\r\n\r")
-            s.close()
-        elif option == 10:
-            # Option 10. Send FILE_NOT_FOUND status.
-            s.send(b"GETFILE FILE_NOT_FOUND\r\n\r\n")
-        elif option == 11:
-            # Option 11. Send ERROR status.
-            s.send(b"GETFILE ERROR\r\n\r\n")
-        elif option == 12:
-            # Option 12. Send INVALID status.
-            s.send(b"GETFILE INVALID\r\n\r\n")
-        elif option == 13:
-            # Option 13. Send wrong scheme.
-            s.send(b"POSTFILE OK 4\r\n\r\nabcd")
-        elif option == 14:
-            # Option 14. Send status not in set.
-            s.send(b"GETFILE WRONG\r\n\r\n")
-        elif option == 1000:
-            # Serve a 2 GB + extra_bytes (exceeds int) file
-            # This can be verified with: sha1sum filename.
-            hash = hashlib.sha1()
-            extra_bytes = 1
-            orig_size = 2**31 + extra_bytes
-            size = orig_size
-            buffer_size = 8192
-
-            s.send(bytes(f"GETFILE OK {size}\r\n\r\n", "UTF-8"))
-            while size > extra_bytes:
-                random_buffer = random_bytes(buffer_size)
-                hash.update(random_buffer)
-                s.send(random_buffer)
-                size -= buffer_size
-            last_buffer = random_bytes(size)
-            hash.update(last_buffer)
-            s.send(last_buffer)
-
-            print('XXX warning, sha1sum does not match files XXX')
-            print(f"size={orig_size}, sha1sum={hash.hexdigest()}")
-        elif option == 1001:
-            # Serve a random sized file with random-sized buffers of random bytes, and show the SHA1 hash.
-            # This can be verified with: sha1sum filename.
-            #
-            # header is part of the buffer.
-            hash = hashlib.sha1()
-            orig_size = random.randint(10_000, 1_000_000)
-            size = orig_size
-
-            header_buffer = bytes(f"GETFILE OK {size}\r\n\r\n", "UTF-8")
-            header_buffer_size = len(header_buffer)
-
-            payload_size = random.randint(min(100, size), min(1_000, size))
-            random_payload = random_bytes(payload_size)
-            
-            first_buffer = header_buffer + random_payload
-            first_buffer_size = len(first_buffer)
-            
-            print(f"header size {header_buffer_size} + payload size {payload_size} = first buffer size {first_buffer_size}")
-
-            # Hash only includes the payload, as the header is not stored on the client.
-            hash.update(random_payload)
-            s.send(first_buffer)
-
-            # Size to send only includes the payload, not the header.
-            size -= payload_size
-            print(f"remaining size {size}")
-
-            while size > 0:
-                buffer_size = random.randint(min(100, size), min(1_000, size))
-                random_buffer = bytes([random.randint(0, 255) for _ in range(0, buffer_size)])
-                hash.update(random_buffer)
-                s.send(random_buffer)
-                size -= buffer_size
-
-            print(f"size={orig_size}, sha1sum={hash.hexdigest()}")
+
+        for action in responses(option):
+            if action is CLOSE:
+                s.close()
+                break
+            if isinstance(action, (int, float)):
+                time.sleep(action)
+            else:
+                s.sendall(action)
+
+
+def load_content(content_filename):
+    """ Load the path to local file mapping. Local files are relative to the content file. """
+    content_dir = os.path.dirname(content_filename)
+    content = {}
+    with open(content_filename, "r") as file:
+        for line in file:
+            entries = line.split()
+            if len(entries) == 2:
+                content[entries[0]] = os.path.join(content_dir, entries[1])
+    return content
+
+
+class FileCache:
+    """ LRU cache of open files and their sizes, shared by the workers. """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.files = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        """ Return (file, size), opening the file on a miss. Raises OSError. """
+        with self.lock:
+            entry = self.files.get(filename)
+            if entry:
+                self.files.move_to_end(filename)
+                return entry
+
+        file = open(filename, "rb", buffering=0)
+        entry = (file, os.fstat(file.fileno()).st_size)
+        with self.lock:
+            self.files[filename] = entry
+            # An evicted file is closed when the last worker sending it lets go.
+            if len(self.files) > self.capacity:
+                self.files.popitem(last=False)
+        return entry
+
+
+class ContentStats:
+    """ Request count, bytes and latency, printed every few seconds. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = collections.Counter()
+        self.nbytes = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def add(self, status, nbytes, latency):
+        with self.lock:
+            self.requests[status] += 1
+            self.nbytes += nbytes
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def report(self, interval):
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                requests, nbytes, latency, max_latency = self.requests, self.nbytes, self.latency, self.max_latency
+                self.reset()
+            count = sum(requests.values())
+            if count:
+                print(
+                    f"{count / interval:0.2f} rps, {nbytes / interval / 1e6:0.2f} MB/s, "
+                    f"latency mean {1000 * latency / count:0.3f} ms, max {1000 * max_latency:0.3f} ms, "
+                    f"{dict(requests)}"
+                )
+
+
+def read_request(s):
+    """ Read up to the end of the request header, across any number of recv() calls.
+    Raises socket.timeout if the client is idle for REQUEST_TIMEOUT. """
+    request = b""
+    s.settimeout(REQUEST_TIMEOUT)
+    while b"\r\n\r\n" not in request and len(request) < MAX_REQUEST_SIZE:
+        data = s.recv(MAX_REQUEST_SIZE - len(request))
+        if not data:
+            break
+        request += data
+    # sendfile() needs a blocking socket.
+    s.settimeout(None)
+    return request
+
+
+def serve_file(s, content, file_cache, stats):
+    """ Answer one GETFILE request from the content mapping, with sendfile for the payload. """
+    start_time = time.perf_counter()
+    status = "INVALID"
+    nbytes = 0
+    try:
+        match = REQUEST_RE.match(read_request(s))
+        try:
+            filename = content.get(match.group(1).decode()) if match else None
+        except UnicodeDecodeError:
+            match = None
+        if not match:
+            s.sendall(b"GETFILE INVALID\r\n\r\n")
+        elif filename is None:
+            status = "FILE_NOT_FOUND"
+            s.sendall(b"GETFILE FILE_NOT_FOUND\r\n\r\n")
         else:
-            # Serve a random sized file with random-sized buffers of random bytes, and show the SHA1 hash.
-            # This can be verified with: sha1sum filename.
-            #
-            # header is not part of the buffer.
-            hash = hashlib.sha1()
-            orig_size = random.randint(10_000, 1_000_000)
-            size = orig_size
-
-            s.send(bytes(f"GETFILE OK {size}\r\n\r\n", "UTF-8"))
-            while size > 0:
-                buffer_size = random.randint(min(100, size), min(1_000, size))
-                random_buffer = random_bytes(buffer_size)
-                hash.update(random_buffer)
-                s.send(random_buffer)
-                size -= buffer_size
-
-            print(f"size={orig_size}, sha1sum={hash.hexdigest()}")
+            try:
+                file, size = file_cache.get(filename)
+            except OSError:
+                status = "ERROR"
+                s.sendall(b"GETFILE ERROR\r\n\r\n")
+            else:
+                status = "OK"
+                s.sendall(bytes(f"GETFILE OK {size}\r\n\r\n", "UTF-8"))
+                # sendfile() takes its own offset, so workers can share the cached descriptor.
+                while nbytes < size:
+                    sent = os.sendfile(s.fileno(), file.fileno(), nbytes, size - nbytes)
+                    if not sent:
+                        break
+                    nbytes += sent
+    except socket.timeout:
+        status = "TIMEOUT"
+    except OSError as e:
+        status = type(e).__name__
+    finally:
+        s.close()
+        stats.add(status, nbytes, time.perf_counter() - start_time)
+
+
+def serve_content(content_filename, backlog, workers):
+    """ Reference file server: a pool of workers answering real GETFILE requests. """
+    content = load_content(content_filename)
+    print(f"{len(content)} paths from {content_filename}, {workers} workers")
+
+    file_cache = FileCache(FILE_CACHE_CAPACITY)
+    stats = ContentStats()
+    threading.Thread(target=stats.report, args=(5,), daemon=True).start()
+
+    ss = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    ss.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    ss.bind((HOST, PORT))
+    ss.listen(backlog)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            s, t = ss.accept()
+            executor.submit(serve_file, s, content, file_cache, stats)
+
+
+async def handle_connection(option, reader, writer):
+    """ Play responses() on one connection, with timers in place of sleeps. """
+    try:
+        # Receive and show the header, don't do anything with it
+        print(await reader.read(8192))
+
+        for action in responses(option):
+            if action is CLOSE:
+                return
+            if isinstance(action, (int, float)):
+                await asyncio.sleep(action)
+            else:
+                writer.write(action)
+                await writer.drain()
+
+        # Like the serial server, leave the connection open once the response is sent.
+        # Other clients are not waiting on this one, so hold it until the client hangs up.
+        while await reader.read(8192):
+            pass
+    except ConnectionError as e:
+        print(f"{writer.get_extra_info('peername')}: {e}")
+    finally:
+        writer.close()
+
+
+async def serve_concurrent(option, backlog):
+    """ Serve every connection at once on an event loop. """
+    # Thousands of connections need thousands of descriptors.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(option, reader, writer),
+        HOST, PORT, backlog=backlog, reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+
+
+    # Which option to test
+    option = int(sys.argv[1]) if len(sys.argv)>1 else 1
+    # serial: one connection at a time. concurrent: all connections at once.
+    mode = sys.argv[2] if len(sys.argv)>2 else "serial"
+    backlog = int(sys.argv[3]) if len(sys.argv)>3 else DEFAULT_BACKLOG
+    print(f"option={option}, mode={mode}, backlog={backlog}")
+
+    if option == 1002:
+        # Hash the stream before accepting, not while the first client waits.
+        print("Hashing option 1002 stream...")
+        stream_payload(2**31 + 1)
+
+    if option == CONTENT_OPTION:
+        # serial: one worker. concurrent: a pool of workers.
+        content_filename = sys.argv[4] if len(sys.argv)>4 else DEFAULT_CONTENT_FILENAME
+        workers = int(sys.argv[5]) if len(sys.argv)>5 else DEFAULT_CONTENT_WORKERS
+        serve_content(content_filename, backlog, workers if mode == "concurrent" else 1)
+    elif mode == "concurrent":
+        asyncio.run(serve_concurrent(option, backlog))
+    else:
+        serve_serial(option, backlog)
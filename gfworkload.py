@@ -1,37 +1,204 @@
 # Workload generator
 # Creates content.txt, workload.txt, and files.
 
+import concurrent.futures
+import hashlib
+import json
+import math
+import os
 import random
+import statistics
+import sys
 
 SERVER_ROOT = "server_root/random"
 PREFIX = "workload/random"
 
-def generate_files(nfiles, min, max):
-    with open("workload.txt", "w") as f:
-        for i in range(0, nfiles):
-            f.write(f"/{PREFIX}{i}\n")
+# A text pattern that is easy to view to see if correct.
+PATTERN = b'0123456789abcdef0123456789abcde\n'
+
+# Files are written from one buffer of the repeated pattern, in writes of up to this size.
+# It is a multiple of the pattern length, so every file is the pattern repeated and cut to size.
+WRITE_SIZE = 1 << 20
+PATTERN_BUFFER = memoryview(PATTERN * (WRITE_SIZE // len(PATTERN)))
+
+# Files per task handed to each worker process.
+CHUNK_SIZE = 256
+
+# Sizes come from a seeded generator, so the same parameters give the same files
+# and an unchanged corpus can be reused.
+DEFAULT_SEED = 6200
+
+# Generator parameters and each file's size and hash, to skip regenerating an unchanged corpus.
+MANIFEST_FILENAME = f"{SERVER_ROOT}/manifest.json"
+
+
+def uniform_size(rng, min, max):
+    return rng.randint(min, max)
+
+
+# Shape of the Pareto distribution zipf_size draws from.
+PARETO_ALPHA = 1.2
+
+
+def log_scale_floor(min, max):
+    # Log-scale distributions cannot start at 0, so from 0 they start at a thousandth of max.
+    return min or (max // 1000 or 1)
+
+
+def lognormal_size(rng, min, max):
+    # Centred on the geometric mean of min and max, which are two sigma either side,
+    # sampled through the inverse CDF truncated to the range, so nothing piles up at the ends.
+    low = log_scale_floor(min, max)
+    if max <= low:
+        return max
+    mu = (math.log(low) + math.log(max)) / 2
+    sigma = (math.log(max) - math.log(low)) / 4
+    normal = statistics.NormalDist(mu, sigma)
+    u = rng.uniform(normal.cdf(math.log(low)), normal.cdf(math.log(max)))
+    return round(math.exp(normal.inv_cdf(u)))
+
+
+def zipf_size(rng, min, max):
+    # Many files close to min, a few large ones up to max: a Pareto distribution from min,
+    # sampled through the inverse CDF truncated at max.
+    low = log_scale_floor(min, max)
+    if max <= low:
+        return max
+    u = rng.uniform(0, 1 - (low / max) ** PARETO_ALPHA)
+    return round(low * (1 - u) ** (-1 / PARETO_ALPHA))
+
+
+def buckets_size(rng, min, max):
+    # Powers of four from min up to max, each equally likely.
+    buckets = [min]
+    while buckets[-1] * 4 <= max:
+        buckets.append(buckets[-1] * 4 or 1)
+    return rng.choice(buckets)
 
-    with open("content.txt", "w") as f:
+
+SIZE_DISTRIBUTIONS = {
+    "uniform": uniform_size,
+    "lognormal": lognormal_size,
+    "zipf": zipf_size,
+    "buckets": buckets_size,
+}
+
+
+def write_file(filename, size):
+    """ Write the file, return its manifest entry. """
+    hash = hashlib.sha1()
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if size:
+            # Reserve the blocks up front, so large files are not fragmented.
+            os.posix_fallocate(fd, 0, size)
+        written = 0
+        while written < size:
+            # Continue from where a short write stopped; WRITE_SIZE is a multiple of the pattern,
+            # so the offset into the buffer is the offset into the file modulo WRITE_SIZE.
+            offset = written % WRITE_SIZE
+            n = os.write(fd, PATTERN_BUFFER[offset:offset + min(WRITE_SIZE - offset, size - written)])
+            hash.update(PATTERN_BUFFER[offset:offset + n])
+            written += n
+    finally:
+        os.close(fd)
+    return {"size": size, "sha1": hash.hexdigest(), "mtime_ns": os.stat(filename).st_mtime_ns}
+
+
+def is_unchanged(filename, size, entry):
+    """ Cheap check that the file on disk is the one in the manifest entry, with the wanted size. """
+    if not entry or entry["size"] != size:
+        return False
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return False
+    return stat.st_size == size and stat.st_mtime_ns == entry["mtime_ns"]
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_FILENAME, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"parameters": None, "files": {}}
+
+
+def generate_files(nfiles, min, max, distribution="uniform", seed=DEFAULT_SEED, processes=None):
+    os.makedirs(SERVER_ROOT, exist_ok=True)
+    size_function = SIZE_DISTRIBUTIONS[distribution]
+    rng = random.Random(seed)
+    manifest = load_manifest()
+    files = {}
+
+    filenames = []
+    sizes = []
+    with open("workload.txt", "w") as workload, open("content.txt", "w") as content:
         for i in range(0, nfiles):
-            f.write(f"/{PREFIX}{i} {SERVER_ROOT}/{i}.bin\n")
+            workload.write(f"/{PREFIX}{i}\n")
+            content.write(f"/{PREFIX}{i} {SERVER_ROOT}/{i}.bin\n")
+            filename = f"{SERVER_ROOT}/{i}.bin"
+            size = size_function(rng, min, max)
+
+            # Only write the files that are missing or differ from the manifest.
+            entry = manifest["files"].get(filename)
+            if is_unchanged(filename, size, entry):
+                files[filename] = entry
+            else:
+                filenames.append(filename)
+                sizes.append(size)
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        for filename, entry in zip(filenames, executor.map(write_file, filenames, sizes, chunksize=CHUNK_SIZE)):
+            files[filename] = entry
+
+    parameters = {"nfiles": nfiles, "min": min, "max": max, "distribution": distribution, "seed": seed}
+    with open(MANIFEST_FILENAME, "w") as f:
+        json.dump({"parameters": parameters, "files": files}, f)
 
-    buffer_size = 4096
-    for i in range(0, nfiles):
-        with open(f"{SERVER_ROOT}/{i}.bin", "wb") as f:
-            size = random.randint(min, max)
+    print(
+        f"{nfiles} files, {distribution} sizes, {sum(entry['size'] for entry in files.values())} bytes, "
+        f"{len(filenames)} written, {nfiles - len(filenames)} reused"
+    )
 
-            # A text pattern that is easy to view to see if correct.
-            pattern = b'0123456789abcdef0123456789abcde\n'
-            for _ in range(0, size // buffer_size):
-                # f.write(np.random.bytes(buffer_size))
-                f.write(pattern * (buffer_size // len(pattern)))
 
-            remaining = size % buffer_size
-            if remaining > 0:
-                # f.write(np.random.bytes(remaining))
-                f.write(pattern * (remaining // len(pattern)))
-                f.write(pattern[0:(remaining % len(pattern))])
+def hash_file(filename):
+    hash = hashlib.sha1()
+    try:
+        with open(filename, "rb") as f:
+            while data := f.read(WRITE_SIZE):
+                hash.update(data)
+    except FileNotFoundError:
+        return None
+    return hash.hexdigest()
+
+
+def verify_files(processes=None):
+    """ Hash every file in the manifest in parallel, return True if they all match. """
+    files = load_manifest()["files"]
+    success = True
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        for filename, sha1 in zip(files, executor.map(hash_file, files, chunksize=CHUNK_SIZE)):
+            if sha1 is None:
+                print(f"Missing: {filename}")
+                success = False
+            elif sha1 != files[filename]["sha1"]:
+                print(f"Hash mismatch: {filename}")
+                success = False
+
+    print(f"{len(files)} files verified, {'all match' if success else 'mismatches found'}")
+    return success
 
 
 if __name__ == '__main__':
-    generate_files(10, 32768, 32768*2)
+    if len(sys.argv) > 1 and sys.argv[1] == "--verify":
+        sys.exit(0 if verify_files() else 1)
+
+    # Arguments: number of files, minimum size, maximum size, the size distribution
+    # (uniform, lognormal, zipf or buckets) and the seed.
+    nfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    min_size = int(sys.argv[2]) if len(sys.argv) > 2 else 32768
+    max_size = int(sys.argv[3]) if len(sys.argv) > 3 else 32768*2
+    distribution = sys.argv[4] if len(sys.argv) > 4 else "uniform"
+    seed = int(sys.argv[5]) if len(sys.argv) > 5 else DEFAULT_SEED
+    generate_files(nfiles, min_size, max_size, distribution, seed)
@@ -2,27 +2,55 @@
 
 """ IPC Stress Test """
 
-from typing import List, Tuple
-
+from typing import List, Optional, Tuple
+
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import ctypes
+import functools
+import hashlib
+import json
+import math
+import mmap
+import multiprocessing
 import os
+import random
+import selectors
 import shutil
+import signal
+import socket
+import sqlite3
+import statistics
+import struct
+from multiprocessing import shared_memory
 import sys
 import glob
+import itertools
+import queue
 import subprocess
+import tempfile
+import threading
 import time
 import re
 
+from gftestclient import LatencyHistogram, response_status
+from gfworkload import DEFAULT_SEED, SIZE_DISTRIBUTIONS
+
 # gfclient_download maximum request count
 MAX_GFCLIENT_DOWNLOAD_REQUEST_COUNT = 1000
 
-# Block size for the dd command.
+# Block size the workload sizes were originally chosen around, for the dd command.
 DD_BLOCK_SIZE = 16
 
-# Use some powers of two plus some multiple of the dd block size,
-# to make generation reasonably fast.
+# Workload files are generated and hashed in pieces of this size.
+WORKLOAD_WRITE_SIZE = 1048576
+
+# Use some powers of two plus some multiple of the dd block size.
 #
-# Bytes per second estimation is only available if request count is an even multiple of
-# the workload sizes, thus the 10 sizes here.
+# The default workload, each requested in turn. --workload gives a spec instead.
 WORKLOAD_SIZES = [
     0,
     563,
@@ -36,7 +64,13 @@ WORKLOAD_SIZES = [
    16 * 1048576 + 33 * DD_BLOCK_SIZE,
 ]
 
-# Alternative: random sizes
+# Alternative: a workload spec file, see load_workload_spec.
+
+# Lines of the workload file that workload.c reads, the most a spec can ask for.
+MAX_WORKLOAD_LINES = 100
+
+# Lines in the workload file generated from a spec, when the spec does not say.
+DEFAULT_WORKLOAD_CYCLE = MAX_WORKLOAD_LINES
 
 # For locals.txt, for simplecached:
 WORKLOAD_LOCAL_PATH = 'ipcstress_files'
@@ -44,52 +78,353 @@ WORKLOAD_LOCAL_PATH = 'ipcstress_files'
 # For workload.txt, for gfclient_download to store:
 WORKLOAD_URL_PATH = 'ipcstress'
 
+# With concurrent downloads, each gfclient_download runs in its own directory with this prefix.
+DOWNLOAD_DIR_PREFIX = 'download'
+
 LOCALS_FILENAME = 'locals-ipcstress.txt'
 WORKLOAD_FILENAME = 'workload-ipcstress.txt'
 
+# The workload file sizes the data files were generated for, to reuse them on the next run.
+WORKLOAD_SIZES_FILENAME = 'sizes.txt'
+
 # Minimum size of the shared memory to use in the tests
 # This value has been know to change from semester to semester
 MIN_SEG_SIZE = 822
 
-def run_sha1sum(filenames: List[str], output_file: str) -> None:
-    """ Run sha1sum on filenames and write to an output file. """
-    # Get the hashes. SHA1 is good enough for this.
-    result = subprocess.run(
-        ['/usr/bin/sha1sum'] + filenames,
-        capture_output=True,
-        check=True)
+# Values tried by the parameter test, in the order of a configuration tuple.
+# The proxy thread count is never below the cache thread count.
+PARAMETER_GRID = {
+    'cache_thread_count': list(range(1, 101, 10)),
+    'proxy_thread_count': list(range(1, 101, 10)),
+    'proxy_segment_count': list(range(1, 101, 10)),
+    'proxy_segment_size': [MIN_SEG_SIZE * 4 ** i for i in range(10) if MIN_SEG_SIZE * 4 ** i <= 1048576],
+}
+
+# Configurations run in parallel each get a directory with this prefix and their own port.
+SWEEP_DIR_PREFIX = 'sweep'
+SWEEP_BASE_PORT = 10823
+
+# The adaptive sweep starts from every SWEEP_COARSE_STEP-th value of each parameter.
+SWEEP_COARSE_STEP = 3
+
+# Resource samples are stored under the workdir, a CSV of samples and a JSON of the run parameters.
+SAMPLES_PATH = 'ipcstress_samples'
+
+# Tmpfs mode runs the tests in a directory here, with copies of these binaries and the workload data files.
+TMPFS_ROOT = '/dev/shm'
+STAGED_BINARIES = ['simplecached', 'webproxy', 'gfclient_download']
+
+# Profiler output of the cache and proxy, in a directory per configuration, with a file per run and process.
+PROFILES_PATH = 'ipcstress_profiles'
+PROFILERS = ['stat', 'record', 'strace']
+PERF_RECORD_FREQUENCY = 99
+# Time for a profiler to start its program, and to write its output after the program exits.
+PROFILE_START_TIMEOUT = 5
+PROFILE_EXIT_TIMEOUT = 60
+SAMPLE_FIELDS = [
+    'time', 'process', 'pid', 'tid', 'comm', 'utime', 'stime', 'minflt', 'majflt',
+    'voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches', 'rss_kb'
+]
 
-    # Store the hashes.
-    with open(output_file, 'wb') as file:
-        file.write(result.stdout)
+# Every run is stored in this SQLite database in the workdir, for the compare test.
+RESULTS_DB_FILENAME = 'ipcstress_results.db'
+RESULTS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    started TEXT,
+    test TEXT,
+    revision TEXT,
+    host TEXT,
+    options TEXT
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER REFERENCES sessions(id),
+    trial INTEGER,
+    cache_thread_count INTEGER,
+    proxy_thread_count INTEGER,
+    proxy_segment_count INTEGER,
+    proxy_segment_size INTEGER,
+    download_thread_count INTEGER,
+    request_count INTEGER,
+    downloads INTEGER,
+    cores INTEGER,
+    storage TEXT,
+    exit_code INTEGER,
+    verified INTEGER,
+    elapsed_time REAL,
+    rps REAL,
+    bps REAL,
+    cache_user_percent REAL,
+    cache_kernel_percent REAL,
+    proxy_user_percent REAL,
+    proxy_kernel_percent REAL
+);
+CREATE TABLE IF NOT EXISTS batches (
+    run_id INTEGER REFERENCES runs(id),
+    batch INTEGER,
+    elapsed_time REAL,
+    request_count INTEGER,
+    rps REAL,
+    bps REAL,
+    cache_user_percent REAL,
+    cache_kernel_percent REAL,
+    proxy_user_percent REAL,
+    proxy_kernel_percent REAL
+);
+'''
+BENCHMARK_FIELDS = [
+    'elapsed_time', 'request_count', 'rps', 'bps',
+    'cache_user_percent', 'cache_kernel_percent', 'proxy_user_percent', 'proxy_kernel_percent'
+]
+# Runs with the same values of these are trials of the same configuration.
+CONFIG_FIELDS = [
+    'cache_thread_count', 'proxy_thread_count', 'proxy_segment_count', 'proxy_segment_size',
+    'download_thread_count', 'request_count', 'downloads', 'cores'
+]
+# Columns added since the first schema, with their definitions, for older result databases.
+RESULTS_ADDED_COLUMNS = {
+    'runs': {'cores': 'INTEGER DEFAULT 0', 'storage': 'TEXT'},
+}
+# The summary of a run, its request count is already in the configuration.
+SUMMARY_FIELDS = [field for field in BENCHMARK_FIELDS if field != 'request_count']
+
+# Two-sided 95% Student's t critical values by degrees of freedom, for confidence intervals.
+T_CRITICAL_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306,
+                 9: 2.262, 10: 2.228, 15: 2.131, 20: 2.086, 30: 2.042, 60: 2.000, 120: 1.980}
+
+# Times the IPC ceiling calibration moves the requests of the workload file through shared memory.
+CALIBRATION_CYCLE_COUNT = 10
+
+# IPC resources to watch for leaks: name -> (path, column of the size in /proc/sysvipc files).
+# /dev/shm entries are sized by the file size, /dev/mqueue entries by the QSIZE they report.
+IPC_RESOURCES = {
+    'posix shm': ('/dev/shm', None),
+    'posix mqueue': ('/dev/mqueue', None),
+    'sysv shm': ('/proc/sysvipc/shm', 'size'),
+    'sysv msg': ('/proc/sysvipc/msg', 'cbytes'),
+    'sysv sem': ('/proc/sysvipc/sem', 'nsems'),
+}
+IPC_MONITOR_INTERVAL = 1
+IPC_MONITOR_REPORT_INTERVAL = 60
+
+# Built-in open-loop client: connections open at once, beyond which due requests wait (and the wait
+# counts in their latency), connection retries while the proxy starts, and the read size.
+OPEN_LOOP_MAX_CONNECTIONS = 512
+OPEN_LOOP_CONNECT_RETRIES = 50
+OPEN_LOOP_READ_SIZE = 1 << 20
+# Workloads with more sizes than this have their latency shown for each power of two of sizes.
+MAX_LATENCY_SIZES = 16
+
+# Where the cache and proxy run on the cores given to them: sharing every core, on the two SMT siblings
+# of each core, or on separate halves of the cores. gfclient_download gets the cores left over.
+PLACEMENTS = ['none', 'same', 'siblings', 'disjoint']
+
+# Progress sampling for the live dashboard, the rolling windows it shows, in seconds.
+PROGRESS_SAMPLE_INTERVAL = 0.25
+PROGRESS_WINDOWS = [1, 10, 60]
+
+# inotify(7) event bits, for the progress monitor to see downloads being written and completed.
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# How often the live verifier looks for newly downloaded files, in seconds.
+LIVE_VERIFY_INTERVAL = 1
+
+# Optional features, set on the command line with --name or --name=value.
+OPTIONS = {
+    # Verify downloaded files while gfclient_download is still running.
+    'live-verify': False,
+    # Number of gfclient_download processes to keep running at once.
+    'downloads': 1,
+    # Parameter test: grid runs every configuration, adaptive refines around the best of a coarse grid.
+    'sweep': 'grid',
+    # Configurations to run at once in the parameter test, 0 for one per three available cores.
+    'jobs': 0,
+    # Store every run in RESULTS_DB_FILENAME.
+    'store': True,
+    # Times to run each configuration, for the mean and confidence interval in compare.
+    'trials': 1,
+    # Sessions for the compare test, 0 for the second latest and the latest.
+    'baseline': 0,
+    'candidate': 0,
+    # Watch POSIX and System V IPC resources during runs, and check they are cleaned up at exit.
+    'ipc-monitor': False,
+    # Requests per second for the built-in open-loop client, used instead of gfclient_download,
+    # 0 for gfclient_download.
+    'rate': 0,
+    # Run in a copy of the workdir under TMPFS_ROOT, to take the disk out of the measurements.
+    'tmpfs': False,
+    # Read the workload data files into the page cache before the runs.
+    'prewarm': False,
+    # Workload spec file, '' for WORKLOAD_SIZES, each requested in turn.
+    'workload': '',
+    # Run the cache and proxy under a profiler, one of PROFILERS, or '' for none.
+    'profile': '',
+    # Pin the cache, proxy and gfclient_download to CPU sets, one of PLACEMENTS.
+    'placement': 'none',
+    # Print rolling rps and MB/s of completed downloads every this many seconds, 0 to turn off.
+    'dashboard': 0,
+    # With the dashboard, seconds without any download progress before the cache and proxy
+    # threads' wait channels and stacks are dumped.
+    'stall-window': 30,
+    # Measure the shared memory ceiling for each segment count and size, and print each run's efficiency.
+    'calibrate': False,
+    # Sample per-thread CPU, faults, context switches and RSS of the cache and proxy this many
+    # times per second, 0 to turn off.
+    'sample-hz': 0,
+}
+
+def create_workload_file(filename: str, size: int) -> str:
+    """ Write size random bytes to filename, return the SHA1 hash. """
+    sha1 = hashlib.sha1()
+    with open(filename, 'wb') as file:
+        remaining = size
+        while remaining:
+            data = os.urandom(min(WORKLOAD_WRITE_SIZE, remaining))
+            sha1.update(data)
+            file.write(data)
+            remaining -= len(data)
+    return sha1.hexdigest()
+
+
+def is_workload_current(path: str, filenames: List[str], sizes: List[int]) -> bool:
+    """ Check whether the data files in path were generated for these sizes. """
+    try:
+        with open(f'{path}/{WORKLOAD_SIZES_FILENAME}', 'r') as file:
+            if file.read().split() != [str(size) for size in sizes]:
+                return False
+        return all(
+            os.path.getsize(filename) == size for filename, size in zip(filenames, sizes)
+        ) and os.path.exists(f'{path}/sha1sum.txt')
+    except FileNotFoundError:
+        return False
+
+
+def workload_sequence(weights: List[float], length: int, rng: random.Random) -> List[int]:
+    """ File indexes for the lines of the workload file, each file in proportion to its weight, shuffled. """
+    total = sum(weights)
+    shares = [length * weight / total for weight in weights]
+    counts = [int(share) for share in shares]
+    # The lines left over go to the largest remainders.
+    for i in sorted(range(len(weights)), key=lambda i: counts[i] - shares[i])[:length - sum(counts)]:
+        counts[i] += 1
+    sequence = [i for i, count in enumerate(counts) for _ in range(count)]
+    rng.shuffle(sequence)
+    return sequence
+
+
+def load_workload_spec(filename: str) -> Tuple[List[int], List[int]]:
+    """ Return the file sizes and the workload file's file indexes, from a JSON spec such as:
+
+    {
+        "seed": 6200,
+        "cycle": 100,
+        "zipf": 1.0,
+        "files": [
+            {"count": 4, "size": 16777216},
+            {"count": 100, "distribution": "lognormal", "min": 512, "max": 1048576},
+            {"count": 2, "size": 0, "weight": 50}
+        ]
+    }
+
+    Each group of files has a fixed size, or sizes from a distribution of gfworkload.SIZE_DISTRIBUTIONS.
+    Files are requested in proportion to their weight: "weight" for each file of the group or "weights"
+    for each file, else 1 / rank ** zipf by their order in the spec (zipf 0, the default, for uniform).
+    The workload file has cycle lines, at most MAX_WORKLOAD_LINES, which gfclient_download goes through
+    in order, repeating.
+    """
+    with open(filename, 'r') as file:
+        spec = json.load(file)
+    rng = random.Random(spec.get('seed', DEFAULT_SEED))
+
+    sizes = []
+    weights = []
+    for group in spec['files']:
+        for i in range(group['count']):
+            if 'size' in group:
+                sizes.append(group['size'])
+            else:
+                size_function = SIZE_DISTRIBUTIONS[group.get('distribution', 'uniform')]
+                sizes.append(size_function(rng, group['min'], group['max']))
+            if 'weights' in group:
+                weights.append(group['weights'][i])
+            elif 'weight' in group:
+                weights.append(group['weight'])
+            else:
+                weights.append(1 / len(sizes) ** spec.get('zipf', 0))
+
+    cycle = spec.get('cycle', DEFAULT_WORKLOAD_CYCLE)
+    if not 0 < cycle <= MAX_WORKLOAD_LINES:
+        sys.exit(f'{filename}: cycle {cycle} must be 1 to {MAX_WORKLOAD_LINES}, the lines workload.c reads')
+    return sizes, workload_sequence(weights, cycle, rng)
+
+
+def workload_request_sizes() -> List[int]:
+    """ Sizes of the requests in the workload file, from --workload or WORKLOAD_SIZES. """
+    if OPTIONS['workload']:
+        sizes, sequence = load_workload_spec(OPTIONS['workload'])
+        return [sizes[i] for i in sequence]
+    return WORKLOAD_SIZES
+
+
+# Sizes of the requests in the order gfclient_download makes them, through the workload file
+# and round again. Set by create_workload.
+request_sizes: List[int] = WORKLOAD_SIZES
+
+
+def expected_bytes(request_count: int) -> int:
+    """ Bytes of request_count requests from the start of the workload file. """
+    cycle_count, extra = divmod(request_count, len(request_sizes))
+    return cycle_count * sum(request_sizes) + sum(request_sizes[:extra])
 
 
 def create_workload(workdir: str):
     """ Create workload. """
+    global request_sizes
 
     # Create path or ignore if already present.
     path = f'{workdir}/{WORKLOAD_LOCAL_PATH}'
     os.makedirs(path, exist_ok=True)
 
-    # Create the files with random content.
-    filenames = []
-    print('Creating workload data files:')
-    for i, size in enumerate(WORKLOAD_SIZES):
-        filename = f'{path}/workload{i}.bin'
-        filenames.append(filename)
-        nblocks = size // DD_BLOCK_SIZE
-
-        subprocess.run([
-            '/usr/bin/dd',
-            'if=/dev/urandom',
-            f'of={filename}',
-            f'bs={DD_BLOCK_SIZE}',
-            f'count={nblocks}'
-        ], check=True)
+    if OPTIONS['workload']:
+        sizes, sequence = load_workload_spec(OPTIONS['workload'])
+        print(f'Workload spec {OPTIONS["workload"]}: {len(sizes)} files, {len(sequence)} requests per cycle')
+    else:
+        sizes, sequence = WORKLOAD_SIZES, list(range(len(WORKLOAD_SIZES)))
+    request_sizes = [sizes[i] for i in sequence]
 
+    filenames = [f'{path}/workload{i}.bin' for i, _ in enumerate(sizes)]
     full_sha1sum_filename = f'{path}/sha1sum.txt'
-    print(f'Creating SHA1 hash file: {full_sha1sum_filename}')
-    run_sha1sum(filenames, full_sha1sum_filename)
+    if is_workload_current(path, filenames, sizes):
+        print(f'Reusing workload data files: {path}')
+    else:
+        # Until the new one is written, nothing is reused, even if this regeneration is interrupted.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(f'{path}/{WORKLOAD_SIZES_FILENAME}')
+
+        # Files from a previous, larger workload would otherwise be counted as downloads.
+        for filename in set(glob.glob(f'{path}/workload*.bin')) - set(filenames):
+            os.remove(filename)
+
+        # Create the files with random content, hashing them as they are written.
+        print('Creating workload data files:')
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            hashes = list(executor.map(create_workload_file, filenames, sizes))
+
+        # Same format as sha1sum.
+        print(f'Creating SHA1 hash file: {full_sha1sum_filename}')
+        with open(full_sha1sum_filename, 'w') as file:
+            for filename, sha1 in zip(filenames, hashes):
+                file.write(f'{sha1}  {filename}\n')
+
+        # Written last, after the old one was removed, so an interrupted run is not reused.
+        with open(f'{path}/{WORKLOAD_SIZES_FILENAME}', 'w') as file:
+            file.write(' '.join(str(size) for size in sizes) + '\n')
 
     # Create the locals file.
     full_locals_filename = f'{workdir}/{LOCALS_FILENAME}'
@@ -102,11 +437,81 @@ def create_workload(workdir: str):
     full_workload_filename = f'{workdir}/{WORKLOAD_FILENAME}'
     print(f'Creating workload file: {full_workload_filename}')
     with open(f'{workdir}/{WORKLOAD_FILENAME}', 'w') as file:
-        for i, _ in enumerate(filenames):
+        for i in sequence:
             file.write(f'/{WORKLOAD_URL_PATH}/workload{i}.bin\n')
 
-    # Delete the result directory if it exists, gfclient_download will recreate it.
-    shutil.rmtree(f'{workdir}/{WORKLOAD_URL_PATH}', ignore_errors=True)
+    # Delete the result directories if they exist, gfclient_download will recreate them.
+    for path in [workdir] + glob.glob(f'{workdir}/{SWEEP_DIR_PREFIX}*'):
+        for result_path in result_paths(path):
+            shutil.rmtree(result_path, ignore_errors=True)
+
+    if OPTIONS['prewarm']:
+        prewarm(filenames)
+
+
+def prewarm(filenames: List[str]) -> None:
+    """ Read the files, so the cache finds them in the page cache instead of waiting for the disk. """
+    buffer = bytearray(WORKLOAD_WRITE_SIZE)
+    nbytes = 0
+    for filename in filenames:
+        with open(filename, 'rb', buffering=0) as file:
+            while n := file.readinto(buffer):
+                nbytes += n
+    print(f'Pre-warmed {len(filenames)} workload data files, {nbytes} bytes')
+
+
+def storage_backend(path: str) -> str:
+    """ File system type of the mount holding path, such as ext4 or tmpfs. """
+    path = os.path.realpath(path)
+    backend = 'unknown'
+    length = -1
+    with open('/proc/self/mounts', 'r') as file:
+        for line in file:
+            _, mount_point, fstype = line.split()[:3]
+            mount_point = mount_point.replace('\\040', ' ')
+            # The longest mount point containing path, the last one mounted if several are the same.
+            if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) >= length:
+                backend = fstype
+                length = len(mount_point)
+    return backend
+
+
+def stage_workdir(workdir: str) -> str:
+    """ Copy the binaries and the workload data files of workdir to a new directory under TMPFS_ROOT, return it. """
+    path = tempfile.mkdtemp(prefix='ipcstress-', dir=TMPFS_ROOT)
+    if storage_backend(path) != 'tmpfs':
+        print(f'{TMPFS_ROOT} is {storage_backend(path)}, not tmpfs')
+    for filename in STAGED_BINARIES:
+        shutil.copy2(f'{workdir}/{filename}', path)
+    # Data files still current for the workload are reused, as on disk.
+    if os.path.isdir(f'{workdir}/{WORKLOAD_LOCAL_PATH}'):
+        shutil.copytree(f'{workdir}/{WORKLOAD_LOCAL_PATH}', f'{path}/{WORKLOAD_LOCAL_PATH}')
+    print(f'Staged {workdir} in {path}')
+    return path
+
+
+def unstage_workdir(path: str, workdir: str) -> None:
+    """ Copy the samples and profiles of a staged workdir back to workdir, and remove it. """
+    for staged in [path] + glob.glob(f'{path}/{SWEEP_DIR_PREFIX}*'):
+        target = workdir + staged[len(path):]
+        for name in (SAMPLES_PATH, PROFILES_PATH):
+            if os.path.isdir(f'{staged}/{name}'):
+                shutil.copytree(f'{staged}/{name}', f'{target}/{name}', dirs_exist_ok=True)
+    shutil.rmtree(path)
+
+
+def load_workload_sizes(workdir: str) -> dict:
+    """ Size of each workload file, by file name. """
+    return {
+        os.path.basename(filename): os.path.getsize(filename)
+        for filename in glob.glob(f'{workdir}/{WORKLOAD_LOCAL_PATH}/workload*.bin')
+    }
+
+
+def result_paths(workdir: str) -> List[str]:
+    """ Directories gfclient_download stores into, including those of concurrent downloads. """
+    return [f'{workdir}/{WORKLOAD_URL_PATH}'] + glob.glob(f'{workdir}/{DOWNLOAD_DIR_PREFIX}*/{WORKLOAD_URL_PATH}')
+
 
 def read_cpu_times(pid: int) -> Tuple[int, int]:
     """ Read utime (user time) and stime (system/kernel time) for a PID, in ticks. """
@@ -115,6 +520,725 @@ def read_cpu_times(pid: int) -> Tuple[int, int]:
         return int(entries[13]), int(entries[14])
 
 
+class ResourceSampler(threading.Thread):
+    """ Record a per-thread resource time series of the cache and proxy, to CSV. """
+
+    def __init__(self, workdir: str, processes: dict, parameters: dict):
+        super().__init__(daemon=True)
+        self.processes = processes
+        self.interval = 1 / OPTIONS['sample-hz']
+        self.stop_event = threading.Event()
+
+        os.makedirs(f'{workdir}/{SAMPLES_PATH}', exist_ok=True)
+        # Several runs may start in the same second during a sweep.
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{processes['cache']}"
+        self.filename = f'{workdir}/{SAMPLES_PATH}/{run_id}.csv'
+        with open(f'{workdir}/{SAMPLES_PATH}/{run_id}.json', 'w') as file:
+            json.dump({'parameters': parameters, 'sample_hz': OPTIONS['sample-hz'], 'samples': self.filename}, file)
+
+    def run(self):
+        with open(self.filename, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(SAMPLE_FIELDS)
+            start_time = time.perf_counter()
+            while not self.stop_event.is_set():
+                sample_time = time.perf_counter() - start_time
+                for name, pid in self.processes.items():
+                    for row in sample_threads(pid):
+                        writer.writerow([f'{sample_time:0.4f}', name, pid] + row)
+                self.stop_event.wait(self.interval - (time.perf_counter() - start_time - sample_time))
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        print(f'Resource samples: {self.filename}')
+
+
+def sample_threads(pid: int) -> List[list]:
+    """ Read tid, comm, utime, stime (ticks), faults, context switches and process RSS for each thread. """
+    rows = []
+    try:
+        tids = os.listdir(f'/proc/{pid}/task')
+    except FileNotFoundError:
+        return rows
+
+    for tid in tids:
+        try:
+            with open(f'/proc/{pid}/task/{tid}/stat', 'r') as file:
+                stat = file.read()
+            with open(f'/proc/{pid}/task/{tid}/status', 'r') as file:
+                status = dict(line.split(':', 1) for line in file if ':' in line)
+        except (FileNotFoundError, ProcessLookupError):
+            # The thread exited between listing and reading.
+            continue
+
+        # comm is in parentheses and may contain spaces, the fields after it start at state.
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        entries = stat[stat.rindex(')') + 2:].split(' ')
+        rows.append([
+            tid,
+            comm,
+            int(entries[11]),
+            int(entries[12]),
+            int(entries[7]),
+            int(entries[9]),
+            int(status['voluntary_ctxt_switches']),
+            int(status['nonvoluntary_ctxt_switches']),
+            int(status.get('VmRSS', '0 kB').split()[0]),
+        ])
+    return rows
+
+
+def snapshot_ipc() -> dict:
+    """ IPC resources in use: resource type -> {id: size}. """
+    snapshot = {}
+    for name, (path, size_column) in IPC_RESOURCES.items():
+        resources = {}
+        try:
+            if size_column:
+                with open(path, 'r') as file:
+                    columns = file.readline().split()
+                    for line in file:
+                        entries = dict(zip(columns, line.split()))
+                        # The second column is the id: shmid, msqid or semid.
+                        resources[entries[columns[1]]] = int(entries[size_column])
+            else:
+                for entry in os.scandir(path):
+                    if path == '/dev/mqueue':
+                        with open(entry.path, 'r') as file:
+                            resources[entry.name] = int(file.read().split()[0].split(':')[1])
+                    else:
+                        resources[entry.name] = entry.stat().st_size
+        except (FileNotFoundError, PermissionError):
+            pass
+        snapshot[name] = resources
+    return snapshot
+
+
+def format_ipc(snapshot: dict) -> str:
+    return ', '.join(
+        f'{name} {len(resources)} ({sum(resources.values())})' for name, resources in snapshot.items()
+    )
+
+
+class IpcMonitor(threading.Thread):
+    """ Snapshot IPC resources during a run, to show growth against requests completed. """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.baseline = snapshot_ipc()
+        self.stop_event = threading.Event()
+        self.requests_done = 0
+        self.first = None
+        self.last = None
+
+    def run(self):
+        report_time = time.monotonic()
+        while not self.stop_event.wait(IPC_MONITOR_INTERVAL):
+            snapshot = (self.requests_done, snapshot_ipc())
+            self.first = self.first or snapshot
+            self.last = snapshot
+            if time.monotonic() - report_time >= IPC_MONITOR_REPORT_INTERVAL:
+                report_time = time.monotonic()
+                print(f'IPC at {snapshot[0]} requests: {format_ipc(snapshot[1])}')
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+        if self.first and self.last and self.last[0] > self.first[0]:
+            first_requests, first_snapshot = self.first
+            last_requests, last_snapshot = self.last
+            per_1000 = 1000 / (last_requests - first_requests)
+            print('IPC growth per 1000 requests: ' + ', '.join(
+                f'{name} {(len(last_snapshot[name]) - len(first_snapshot[name])) * per_1000:+0.2f} '
+                f'({(sum(last_snapshot[name].values()) - sum(first_snapshot[name].values())) * per_1000:+0.0f})'
+                for name in IPC_RESOURCES
+            ))
+
+    def check_cleanup(self) -> bool:
+        """ After the cache and proxy exit, report IPC resources they left behind. """
+        snapshot = snapshot_ipc()
+        success = True
+        for name, resources in snapshot.items():
+            for resource_id, size in resources.items():
+                if resource_id not in self.baseline[name]:
+                    print(f'IPC leak: {name} {resource_id} ({size})')
+                    success = False
+        return success
+
+
+class OpenLoopClient(threading.Thread):
+    """ GETFILE client used instead of gfclient_download: requests the workload paths at a fixed rate
+    whatever the responses take, so a slow proxy does not slow the arrivals, and times each request
+    from when it was due, not when it was sent, to correct for coordinated omission. """
+
+    def __init__(self, workdir: str, port: int, request_count: int, rate: int):
+        super().__init__(daemon=True)
+        self.port = port
+        self.request_count = request_count
+        self.rate = rate
+        with open(f'{workdir}/{WORKLOAD_FILENAME}', 'r') as file:
+            self.paths = [line.strip() for line in file if line.strip()]
+        self.workload_sha1 = load_workload_hashes(workdir)
+        self.workload_sizes = load_workload_sizes(workdir)
+
+        # Latency of the requests for each workload size, or each power of two of sizes for a spec with many.
+        sizes = sorted(set(self.workload_sizes.values()))
+        self.size_classes = len(sizes) > MAX_LATENCY_SIZES
+        self.histograms = {self.size_key(size): LatencyHistogram() for size in sizes}
+        self.statuses = collections.Counter()
+        self.mismatches = 0
+        self.completed = 0
+        # Payload bytes of completed requests, and of all received so far, for progress.
+        self.nbytes = 0
+        self.received = 0
+
+        # A byte is written to the pipe for each batch of MAX_GFCLIENT_DOWNLOAD_REQUEST_COUNT completed
+        # requests put on the queue, so the selector wakes for it as for a gfclient_download exit.
+        self.batches = queue.Queue()
+        self.read_fd, self.write_fd = os.pipe()
+        self.loop = None
+        self.task = None
+
+    def run(self):
+        try:
+            asyncio.run(self.generate())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            os.close(self.write_fd)
+
+    async def generate(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        connections = asyncio.Semaphore(OPEN_LOOP_MAX_CONNECTIONS)
+        self.batch = (time.perf_counter(), 0, 0)
+
+        start_time = time.perf_counter()
+        # Only the requests in flight, so a long run does not keep a finished task per request.
+        pending = set()
+        for i in range(self.request_count):
+            due_time = start_time + i / self.rate
+            delay = due_time - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(self.request(self.paths[i % len(self.paths)], due_time, connections))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+
+    async def request(self, path: str, due_time: float, connections: asyncio.Semaphore):
+        async with connections:
+            try:
+                status, sha1, length = await self.get_file(path)
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as error:
+                status, sha1, length = type(error).__name__, None, 0
+        end_time = time.perf_counter()
+
+        filename = os.path.basename(path)
+        self.statuses[status] += 1
+        if status == 'OK' and sha1 != self.workload_sha1.get(filename):
+            print(f'Hash mismatch (client): {path}')
+            self.mismatches += 1
+        self.histograms[self.size_key(self.workload_sizes[filename])].record(end_time - due_time)
+        self.completed += 1
+        self.nbytes += length
+
+        start_time, batch_count, batch_bytes = self.batch
+        self.batch = (start_time, batch_count + 1, batch_bytes + length)
+        if self.batch[1] == MAX_GFCLIENT_DOWNLOAD_REQUEST_COUNT or self.completed == self.request_count:
+            self.batches.put((start_time, end_time) + self.batch[1:])
+            os.write(self.write_fd, b'\0')
+            self.batch = (end_time, 0, 0)
+
+    async def get_file(self, path: str) -> Tuple[str, Optional[str], int]:
+        """ Return the status, SHA1 of the payload, and payload bytes received. """
+        for _ in range(OPEN_LOOP_CONNECT_RETRIES):
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+                break
+            except ConnectionRefusedError:
+                # The proxy is still starting.
+                await asyncio.sleep(0.1)
+        else:
+            return 'ConnectionRefusedError', None, 0
+
+        try:
+            writer.write(f'GETFILE GET {path}\r\n\r\n'.encode())
+            header = await reader.readuntil(b'\r\n\r\n')
+            status = response_status(header)
+            entries = header[:-4].split(b' ')
+            if status != 'OK':
+                return status, None, 0
+            if len(entries) != 3 or not entries[2].isdigit():
+                return 'MALFORMED', None, 0
+
+            length = int(entries[2])
+            hash = hashlib.sha1()
+            received = 0
+            while received < length:
+                data = await reader.read(min(OPEN_LOOP_READ_SIZE, length - received))
+                if not data:
+                    return 'SHORT', None, received
+                hash.update(data)
+                received += len(data)
+                self.received += len(data)
+            return status, hash.hexdigest(), received
+        finally:
+            writer.close()
+
+    def size_key(self, size: int) -> int:
+        if not self.size_classes or not size:
+            return size
+        return 1 << (size.bit_length() - 1)
+
+    def print_latency(self):
+        """ Print the latency percentiles for each workload size, to show whether the large
+        transfers hold up the small ones. """
+        lines = [f'Requests: {dict(self.statuses)}, {self.mismatches} hash mismatches']
+        for size, histogram in self.histograms.items():
+            if histogram.total:
+                lines.append(
+                    f'  {size:>10}{"+" if self.size_classes else " "} bytes: {histogram.total} requests, latency ms '
+                    f'p50 {histogram.percentile(50) / 1000:0.3f}, p99 {histogram.percentile(99) / 1000:0.3f}, '
+                    f'p99.9 {histogram.percentile(99.9) / 1000:0.3f}, max {histogram.max / 1000:0.3f}'
+                )
+        print('\n'.join(lines) + '\n', end='')
+
+    @property
+    def success(self) -> bool:
+        return self.mismatches == 0 and self.statuses['OK'] == self.request_count
+
+    def stop(self):
+        """ Cancel the requests still in flight, if the cache or proxy exited. """
+        try:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+        except (AttributeError, RuntimeError):
+            # Not started yet, or already finished.
+            pass
+        self.join()
+
+
+class Inotify:
+    """ inotify(7) through libc: events for the files in watched directories. """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.fd, selectors.EVENT_READ)
+        # Watch descriptor -> directory.
+        self.paths = {}
+
+    def watch(self, path: str, mask: int) -> bool:
+        """ Watch the directory for the mask events, return False if it cannot be watched (yet). """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            return False
+        self.paths[wd] = path
+        return True
+
+    def read(self, timeout: float) -> List[Tuple[Optional[str], int, str]]:
+        """ Wait up to timeout seconds for events, return them as (directory, mask, file name). """
+        events = []
+        if not self.selector.select(timeout):
+            return events
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+                offset += length
+                events.append((self.paths.get(wd), mask, name))
+
+    def close(self):
+        self.selector.close()
+        os.close(self.fd)
+
+
+def dump_threads(name: str, pid: int) -> None:
+    """ Print the wait channel and kernel stack of each thread, to show where a stalled process is blocked. """
+    try:
+        tids = sorted(os.listdir(f'/proc/{pid}/task'), key=int)
+    except FileNotFoundError:
+        print(f'{name} ({pid}) has exited')
+        return
+
+    lines = [f'{name} ({pid}), {len(tids)} threads:']
+    for tid in tids:
+        try:
+            with open(f'/proc/{pid}/task/{tid}/comm', 'r') as file:
+                comm = file.read().strip()
+            with open(f'/proc/{pid}/task/{tid}/wchan', 'r') as file:
+                wchan = file.read().strip() or '-'
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        lines.append(f'  {tid} {comm}: {wchan}')
+        try:
+            with open(f'/proc/{pid}/task/{tid}/stack', 'r') as file:
+                lines.extend(f'    {line.strip()}' for line in file)
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        except PermissionError:
+            # Kernel stacks need root.
+            pass
+    print('\n'.join(lines) + '\n', end='')
+
+
+class ProgressMonitor(threading.Thread):
+    """ Count completed downloads continuously, print rolling rps and MB/s, and dump the
+    cache and proxy threads when nothing has progressed for the stall window.
+    Downloads are counted as gfclient_download closes the files it wrote, through inotify, which may
+    miss a few, so the figures are a lower bound. With the built-in client, its exact counts are used. """
+
+    def __init__(self, workdir: str, processes: dict, client: Optional[OpenLoopClient] = None):
+        super().__init__(daemon=True)
+        self.workdir = workdir
+        self.processes = processes
+        self.client = client
+        self.workload_sizes = load_workload_sizes(workdir)
+        self.stop_event = threading.Event()
+        # (time, requests, bytes) over the longest window.
+        self.samples = collections.deque()
+        # Directories watched, for new result directories and for the files in them.
+        self.watched = set()
+        # Files written before this are left over from an earlier run in the same directories.
+        self.start_time_ns = time.time_ns()
+
+    def run(self):
+        inotify = None if self.client else Inotify()
+        received = 0
+        requests = 0
+        nbytes = 0
+        progress_time = report_time = stall_start_time = time.monotonic()
+        stalled = False
+
+        while not self.stop_event.is_set():
+            if self.client:
+                # The built-in client does not write files, but counts as it goes.
+                self.stop_event.wait(PROGRESS_SAMPLE_INTERVAL)
+                progressed = self.client.received != received
+                received = self.client.received
+                requests = self.client.completed
+                nbytes = self.client.nbytes
+            else:
+                progressed, completed, completed_bytes = self.watch_downloads(inotify, PROGRESS_SAMPLE_INTERVAL)
+                requests += completed
+                nbytes += completed_bytes
+
+            now = time.monotonic()
+            self.samples.append((now, requests, nbytes))
+            while self.samples[0][0] < now - max(PROGRESS_WINDOWS) - PROGRESS_SAMPLE_INTERVAL:
+                self.samples.popleft()
+
+            if progressed:
+                progress_time = now
+                if stalled:
+                    print(f'Progress resumed after {now - stall_start_time:0.1f}s')
+                    stalled = False
+            elif not stalled and now - progress_time >= OPTIONS['stall-window']:
+                stalled = True
+                stall_start_time = progress_time
+                print(f'Stall: no progress for {now - progress_time:0.1f}s at {requests} requests')
+                for name, pid in self.processes.items():
+                    dump_threads(name, pid)
+
+            if now - report_time >= OPTIONS['dashboard']:
+                report_time = now
+                rates = [self.rate(window) for window in PROGRESS_WINDOWS]
+                print(
+                    f'{requests} requests, rps ' +
+                    '/'.join(f'{rps:0.1f}' for rps, _ in rates) +
+                    ', MB/s ' +
+                    '/'.join(f'{bps / 1e6:0.1f}' for _, bps in rates) +
+                    f' over {"/".join(f"{window}s" for window in PROGRESS_WINDOWS)}' +
+                    ('' if self.client else ', lower bounds') + '\n', end=''
+                )
+
+        if inotify:
+            inotify.close()
+
+    def add_watches(self, inotify: Inotify) -> Tuple[int, int]:
+        """ Watch the workdir and download directories for new result directories, and those for files.
+        Return the requests and bytes completed in result directories before they were watched. """
+        completed = 0
+        completed_bytes = 0
+        parents = [self.workdir] + glob.glob(f'{self.workdir}/{DOWNLOAD_DIR_PREFIX}*')
+        for path in parents:
+            if path not in self.watched and inotify.watch(path, IN_CREATE):
+                self.watched.add(path)
+        for path in result_paths(self.workdir):
+            if path not in self.watched and inotify.watch(path, IN_MODIFY | IN_CLOSE_WRITE):
+                self.watched.add(path)
+                # gfclient_download may have written the first files before the watch was in place.
+                for name, size in self.workload_sizes.items():
+                    with contextlib.suppress(FileNotFoundError):
+                        stat = os.stat(f'{path}/{name}')
+                        if stat.st_size == size and stat.st_mtime_ns >= self.start_time_ns:
+                            completed += 1
+                            completed_bytes += size
+        return completed, completed_bytes
+
+    def watch_downloads(self, inotify: Inotify, interval: float) -> Tuple[bool, int, int]:
+        """ Wait interval seconds, return whether any download file was written,
+        and the requests and bytes completed. """
+        deadline = time.monotonic() + interval
+        completed, completed_bytes = self.add_watches(inotify)
+        progressed = completed > 0
+        while (timeout := deadline - time.monotonic()) > 0:
+            for _, mask, name in inotify.read(timeout):
+                if mask & IN_Q_OVERFLOW:
+                    print('Progress: inotify queue overflowed, some downloads were not counted')
+                elif mask & IN_ISDIR and mask & IN_CREATE:
+                    # A download directory or result directory appeared, watch it right away.
+                    found, found_bytes = self.add_watches(inotify)
+                    progressed = progressed or found > 0
+                    completed += found
+                    completed_bytes += found_bytes
+                elif name in self.workload_sizes:
+                    progressed = True
+                    # gfclient_download closes each file it downloads once.
+                    if mask & IN_CLOSE_WRITE:
+                        completed += 1
+                        completed_bytes += self.workload_sizes[name]
+        return progressed, completed, completed_bytes
+
+    def rate(self, window: float) -> Tuple[float, float]:
+        """ Requests and bytes per second over the last window seconds, or as much of it as sampled. """
+        now, requests, nbytes = self.samples[-1]
+        for then, then_requests, then_bytes in self.samples:
+            if then >= now - window:
+                break
+        if now == then:
+            return 0.0, 0.0
+        return (requests - then_requests) / (now - then), (nbytes - then_bytes) / (now - then)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+def watch_process(selector: selectors.BaseSelector, popen: subprocess.Popen) -> None:
+    """ Make the selector wake up when the process exits, through a pidfd. """
+    selector.register(os.pidfd_open(popen.pid), selectors.EVENT_READ, popen)
+
+
+def close_watches(selector: selectors.BaseSelector) -> None:
+    """ Close the selector and the pidfds still registered with it. """
+    for key in list(selector.get_map().values()):
+        selector.unregister(key.fd)
+        os.close(key.fd)
+    selector.close()
+
+
+def download_dir(workdir: str, index: int) -> str:
+    """ Directory gfclient_download number index runs in, and stores its downloads under. """
+    if OPTIONS['downloads'] == 1:
+        return workdir
+
+    # Each concurrent download gets its own directory, with links to the binary and the workload.
+    path = f'{workdir}/{DOWNLOAD_DIR_PREFIX}{index}'
+    os.makedirs(path, exist_ok=True)
+    for filename in ['gfclient_download', WORKLOAD_FILENAME]:
+        if not os.path.lexists(f'{path}/{filename}'):
+            os.symlink(f'../{filename}', f'{path}/{filename}')
+    return path
+
+
+@functools.lru_cache(maxsize=None)
+def physical_cores() -> List[List[int]]:
+    """ The CPUs ipcstress may run on, grouped by physical core, SMT siblings together. """
+    cores = {}
+    for cpu in sorted(os.sched_getaffinity(0)):
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list', 'r') as file:
+                siblings = file.read().strip()
+        except FileNotFoundError:
+            siblings = str(cpu)
+        cores.setdefault(siblings, []).append(cpu)
+    return list(cores.values())
+
+
+def placement_cpus(placement: str, core_count: Optional[int] = None) -> Optional[dict]:
+    """ CPU sets for the cache, proxy and gfclient_download processes, with the cache and proxy
+    on core_count physical cores (default all of them). None for no pinning. """
+    if placement == 'none':
+        return None
+
+    cores = physical_cores()
+    used = cores[:core_count or len(cores)]
+    spare = cores[len(used):]
+    # The client gets the cores left over, so it does not compete with the cache and proxy, if there are any.
+    # Parallel sweep jobs are all given the same cores, and do compete with each other.
+    download = set(itertools.chain(*spare)) or set(itertools.chain(*used))
+
+    if placement == 'same':
+        cache = proxy = set(itertools.chain(*used))
+    elif placement == 'siblings':
+        if any(len(core) < 2 for core in used):
+            sys.exit('Placement siblings needs SMT, these cores have one thread each')
+        cache = {core[0] for core in used}
+        proxy = {core[1] for core in used}
+    elif placement == 'disjoint':
+        if len(used) < 2:
+            sys.exit('Placement disjoint needs at least two cores')
+        cache = set(itertools.chain(*used[:len(used) // 2]))
+        proxy = set(itertools.chain(*used[len(used) // 2:]))
+    else:
+        sys.exit(f'Unknown placement: {placement}, placements are {PLACEMENTS}')
+
+    return {'cache': cache, 'proxy': proxy, 'download': download}
+
+
+@contextlib.contextmanager
+def pinned(cpus: Optional[set]):
+    """ Pin the calling thread to cpus for the block, so the processes and threads it starts inherit them. """
+    if cpus is None:
+        yield
+        return
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+
+def profiler_command(profile: str, output: str) -> List[str]:
+    """ Command prefix to run a program under the profiler, writing to files starting with output. """
+    if profile == 'stat':
+        command = ['perf', 'stat', '-o', f'{output}.perf-stat.txt', '--']
+    elif profile == 'record':
+        command = ['perf', 'record', '-g', '-F', str(PERF_RECORD_FREQUENCY), '-q', '-o', f'{output}.perf.data', '--']
+    elif profile == 'strace':
+        command = ['strace', '-c', '-f', '-o', f'{output}.strace.txt', '--']
+    else:
+        sys.exit(f'Unknown profiler: {profile}, profilers are {PROFILERS}')
+    if not shutil.which(command[0]):
+        sys.exit(f'{command[0]} is needed for --profile={profile}')
+    return command
+
+
+def profiled_pid(popen: subprocess.Popen, program: str) -> int:
+    """ Pid of the program the profiler in popen runs, once it has started, or the profiler's pid. """
+    # comm is the program name cut to 15 characters.
+    comm = os.path.basename(program)[:15]
+    deadline = time.monotonic() + PROFILE_START_TIMEOUT
+    while time.monotonic() < deadline and popen.poll() is None:
+        for tid in os.listdir(f'/proc/{popen.pid}/task'):
+            try:
+                with open(f'/proc/{popen.pid}/task/{tid}/children', 'r') as file:
+                    children = file.read().split()
+            except FileNotFoundError:
+                continue
+            for child in children:
+                try:
+                    with open(f'/proc/{child}/comm', 'r') as file:
+                        if file.read().strip() == comm:
+                            return int(child)
+                except FileNotFoundError:
+                    continue
+        time.sleep(0.01)
+    print(f'{program} not found under {popen.args[0]}, measuring the profiler instead')
+    return popen.pid
+
+
+def terminate(popen: subprocess.Popen, pid: int) -> None:
+    """ Send SIGTERM to pid, the program popen runs, directly or under a profiler that then exits with it. """
+    if popen.poll() is None:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def fold_perf_script(lines) -> collections.Counter:
+    """ Count the stacks in perf script -F comm,ip,sym output, as root-first folded stacks for flame graphs. """
+    stacks = collections.Counter()
+    comm = None
+    frames = []
+    # A blank line ends each sample.
+    for line in itertools.chain(lines, ['']):
+        if not line.strip():
+            if comm is not None:
+                stacks[';'.join([comm] + frames[::-1])] += 1
+            comm = None
+            frames = []
+        elif not line[0].isspace():
+            comm = line.strip().replace(' ', '_')
+        else:
+            # Frames are leaf first: address, then the symbol if it is known.
+            entries = line.split(None, 1)
+            frames.append(entries[1].strip().replace(' ', '_') if len(entries) > 1 else '[unknown]')
+    return stacks
+
+
+def fold_perf_record(output: str) -> None:
+    """ Write the folded stacks of output.perf.data to output.folded. """
+    result = subprocess.run(
+        ['perf', 'script', '-F', 'comm,ip,sym', '-i', f'{output}.perf.data'], capture_output=True, text=True)
+    if result.returncode:
+        print(f'perf script failed for {output}.perf.data: {result.stderr.strip()}')
+        return
+    with open(f'{output}.folded', 'w') as file:
+        for stack, count in sorted(fold_perf_script(result.stdout.splitlines()).items()):
+            file.write(f'{stack} {count}\n')
+
+
+def print_benchmark(
+    prefix: str,
+    elapsed_time: float,
+    rps: float,
+    request_count: int,
+    cpu_times: List[float],
+    cpu_elapsed_time: float,
+    nbytes: Optional[int] = None
+) -> dict:
+    """ Print requests and bytes per second, and cache and proxy CPU use over cpu_elapsed_time.
+    Return the printed figures. nbytes is the byte count, if not the expected bytes of the requests. """
+    cache_utime, cache_stime, proxy_utime, proxy_stime = cpu_times
+    cache_ttime = cache_utime + cache_stime
+    proxy_ttime = proxy_utime + proxy_stime
+
+    if nbytes is None:
+        nbytes = expected_bytes(request_count)
+    bps = nbytes / elapsed_time
+    line = f'{prefix} {elapsed_time:0.2f}s, {rps:0.2f} rps, {bps:0.0f} bps, '
+
+    # One write with the newline, so lines from runs in parallel do not mix.
+    print(
+        line +
+        'cache: '
+        f'{cache_utime}s {100 * cache_utime / cpu_elapsed_time:0.2f}% user, '
+        f'{cache_stime}s {100 * cache_stime / cpu_elapsed_time:0.2f}% kernel, '
+        f'{cache_ttime}s {100 * cache_ttime / cpu_elapsed_time:0.2f}% total, '
+        'proxy: '
+        f'{proxy_utime}s {100 * proxy_utime / cpu_elapsed_time:0.2f}% user, '
+        f'{proxy_stime}s {100 * proxy_stime / cpu_elapsed_time:0.2f}% kernel, '
+        f'{proxy_ttime}s {100 * proxy_ttime / cpu_elapsed_time:0.2f}% total\n',
+        end=''
+    )
+
+    return {
+        'elapsed_time': elapsed_time,
+        'request_count': request_count,
+        'rps': rps,
+        'bps': bps,
+        'cache_user_percent': 100 * cache_utime / cpu_elapsed_time,
+        'cache_kernel_percent': 100 * cache_stime / cpu_elapsed_time,
+        'proxy_user_percent': 100 * proxy_utime / cpu_elapsed_time,
+        'proxy_kernel_percent': 100 * proxy_stime / cpu_elapsed_time,
+    }
+
+
 def run_ipcstress(
     workdir: str,
     cache_thread_count: int,
@@ -123,9 +1247,18 @@ def run_ipcstress(
     proxy_segment_size: int,
     download_thread_count: int,
     request_count: int,
-    port: int
+    port: int,
+    results: Optional[dict] = None,
+    affinity: Optional[dict] = None
 ) -> int:
-    """ Run IPC Stress. Return 0 for normal exit. """
+    """ Run IPC Stress. Return 0 for normal exit.
+    If results is given, the per-batch and summary figures are stored in it.
+    If affinity is given, the cache, proxy and downloads are pinned to its CPU sets. """
+    if results is None:
+        results = {}
+    if affinity is None:
+        affinity = {}
+    results['batches'] = []
 
     # Compute the ticks per second
     result = subprocess.run(['/usr/bin/getconf', 'CLK_TCK'], capture_output=True, check=True)
@@ -133,222 +1266,640 @@ def run_ipcstress(
 
     remaining_request_count = request_count
 
-    popen_cache = subprocess.Popen([
-        './simplecached',
-        '-c',
-        f'./{LOCALS_FILENAME}',
-        '-t',
-        str(cache_thread_count)
-    ], cwd=workdir
-    )
+    # Taken before the cache and proxy start, to find what they leave behind.
+    ipc_monitor = None
+    if OPTIONS['ipc-monitor']:
+        ipc_monitor = IpcMonitor()
+
+    # The cache and proxy run under the profiler, with their output in a directory for the configuration.
+    cache_profiler = []
+    proxy_profiler = []
+    if OPTIONS['profile']:
+        path = (
+            f'{workdir}/{PROFILES_PATH}/cache{cache_thread_count}-proxy{proxy_thread_count}-'
+            f'segments{proxy_segment_count}x{proxy_segment_size}-download{download_thread_count}-'
+            f'requests{request_count}'
+        )
+        os.makedirs(path, exist_ok=True)
+        # Several trials of a configuration may be run, to the millisecond.
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}.{time.time_ns() // 1000000 % 1000:03d}"
+        profile_outputs = [f'{path}/{run_id}-cache', f'{path}/{run_id}-proxy']
+        cache_profiler = profiler_command(OPTIONS['profile'], profile_outputs[0])
+        proxy_profiler = profiler_command(OPTIONS['profile'], profile_outputs[1])
+
+    with pinned(affinity.get('cache')):
+        popen_cache = subprocess.Popen(cache_profiler + [
+            './simplecached',
+            '-c',
+            f'./{LOCALS_FILENAME}',
+            '-t',
+            str(cache_thread_count)
+        ], cwd=workdir
+        )
     # print(f'cache pid: {popen_cache.pid}')
 
-    popen_proxy = subprocess.Popen([
-        './webproxy',
-        '-n',
-        str(proxy_segment_count),
-        '-p',
-        str(port),
-        '-t',
-        str(proxy_thread_count),
-        '-z',
-        str(proxy_segment_size)
-    ], cwd=workdir
-    )
+    with pinned(affinity.get('proxy')):
+        popen_proxy = subprocess.Popen(proxy_profiler + [
+            './webproxy',
+            '-n',
+            str(proxy_segment_count),
+            '-p',
+            str(port),
+            '-t',
+            str(proxy_thread_count),
+            '-z',
+            str(proxy_segment_size)
+        ], cwd=workdir
+        )
     # print(f'proxy pid: {popen_proxy.pid}')
 
+    # Measure and signal the cache and proxy themselves, not their profilers.
+    cache_pid = profiled_pid(popen_cache, 'simplecached') if cache_profiler else popen_cache.pid
+    proxy_pid = profiled_pid(popen_proxy, 'webproxy') if proxy_profiler else popen_proxy.pid
+
     # Give the proxy a quarter second to start, to eliminate the client message:
     # Failed to connect.  Trying again....
     time.sleep(0.250)
 
     actual_request_done = 0
-    popen_download = None
-    download_poll = None
+    batch_count = 0
+
+    # gfclient_download processes in flight: popen -> (index, start time, request count)
+    downloads = {}
+    free_indexes = list(range(OPTIONS['downloads']))
+    # Split the requests across the downloads, so runs under the maximum still keep them all busy.
+    batch_size = min(MAX_GFCLIENT_DOWNLOAD_REQUEST_COUNT, math.ceil(request_count / OPTIONS['downloads']))
 
     # Benchmarking:
-    start_time = None
-    start_cache_utime, start_cache_stime = read_cpu_times(popen_cache.pid)
-    start_proxy_utime, start_proxy_stime = read_cpu_times(popen_proxy.pid)
+    start_cache_utime, start_cache_stime = read_cpu_times(cache_pid)
+    start_proxy_utime, start_proxy_stime = read_cpu_times(proxy_pid)
+
+    # Wake up as soon as any of the processes exits, instead of polling.
+    selector = selectors.DefaultSelector()
+    watch_process(selector, popen_cache)
+    watch_process(selector, popen_proxy)
+
+    live_verifier = None
+    if OPTIONS['live-verify']:
+        live_verifier = LiveVerifier(workdir)
+        live_verifier.start()
+
+    sampler = None
+    if OPTIONS['sample-hz']:
+        sampler = ResourceSampler(
+            workdir,
+            {'cache': cache_pid, 'proxy': proxy_pid},
+            {
+                'cache_thread_count': cache_thread_count,
+                'proxy_thread_count': proxy_thread_count,
+                'proxy_segment_count': proxy_segment_count,
+                'proxy_segment_size': proxy_segment_size,
+                'download_thread_count': download_thread_count,
+                'request_count': request_count,
+                'downloads': OPTIONS['downloads'],
+            }
+        )
+        sampler.start()
 
-    # Summary for the end.
-    total_elapsed_time = 0
+    if ipc_monitor:
+        ipc_monitor.start()
+
+    # Summary for the end, over the wall time from the first spawn to the last exit.
+    first_start_time = None
+    report_time = None
     total_elapsed_cache_utime = 0
     total_elapsed_cache_stime = 0
     total_elapsed_proxy_utime = 0
     total_elapsed_proxy_stime = 0
-    
-    # print(f'download pid: {popen_download.pid}')
-    while True:
-        if popen_download:
-            download_poll = popen_download.poll()
-
-        # Download if first time or previous request complete.
-        # explicit "is not None" is needed because the return code may be 0
-        if (download_poll is not None) or not popen_download:
-            if start_time:
-                elapsed_time = time.time() - start_time
-
-                # Requests per second
-                rps = actual_request_count / elapsed_time
-                actual_request_done += actual_request_count
-
-                # CPU time (user and system)
-                cache_utime, cache_stime = read_cpu_times(popen_cache.pid)
-                proxy_utime, proxy_stime = read_cpu_times(popen_proxy.pid)
-                elapsed_cache_utime = (cache_utime - start_cache_utime) / ticks_per_second
-                elapsed_cache_stime = (cache_stime - start_cache_stime) / ticks_per_second
-                elapsed_proxy_utime = (proxy_utime - start_proxy_utime) / ticks_per_second
-                elapsed_proxy_stime = (proxy_stime - start_proxy_stime) / ticks_per_second
-                (start_cache_utime, start_cache_stime) = (cache_utime, cache_stime)
-                (start_proxy_utime, start_proxy_stime) = (proxy_utime, proxy_stime)
-
-                elapsed_cache_ttime = elapsed_cache_utime + elapsed_cache_stime
-                elapsed_proxy_ttime = elapsed_proxy_utime + elapsed_proxy_stime
-
-                # For the summary:
-                total_elapsed_cache_utime += elapsed_cache_utime
-                total_elapsed_cache_stime += elapsed_cache_stime
-                total_elapsed_proxy_utime += elapsed_proxy_utime
-                total_elapsed_proxy_stime += elapsed_proxy_stime
-
-                # bps is only possible if the requests are a multiple of the workload.
-                # Otherwise, gfclient_download does not evenly distribute the requests
-                # across the workload files.
-                request_count_chunk, request_count_extra = divmod(actual_request_count, len(WORKLOAD_SIZES))
-                if not request_count_extra:
-                    nbytes = request_count_chunk * sum(WORKLOAD_SIZES)
-                    bps = nbytes / elapsed_time
-                    print(
-                        f'{actual_request_done}/{request_count} in {elapsed_time:0.2f}s, {rps:0.2f} rps, {bps:0.0f} bps, ',
-                        end=''
-                    )
-                else:
-                    print(
-                        f'{actual_request_done}/{request_count} in {elapsed_time:0.2f}s, {rps:0.2f} rps, ',
-                        end=''
-                    )
-
-                print(
-                    'cache: '
-                    f'{elapsed_cache_utime}s {100 * elapsed_cache_utime / elapsed_time:0.2f}% user, '
-                    f'{elapsed_cache_stime}s {100 * elapsed_cache_stime / elapsed_time:0.2f}% kernel, '
-                    f'{elapsed_cache_ttime}s {100 * elapsed_cache_ttime / elapsed_time:0.2f}% total, '
-                    'proxy: '
-                    f'{elapsed_proxy_utime}s {100 * elapsed_proxy_utime / elapsed_time:0.2f}% user, '
-                    f'{elapsed_proxy_stime}s {100 * elapsed_proxy_stime / elapsed_time:0.2f}% kernel, '
-                    f'{elapsed_proxy_ttime}s {100 * elapsed_proxy_ttime / elapsed_time:0.2f}% total'
-                )
 
-            if remaining_request_count == 0:
-                break
+    # The built-in client runs the whole workload, in place of the gfclient_download processes.
+    client = None
+    if OPTIONS['rate']:
+        client = OpenLoopClient(workdir, port, request_count, OPTIONS['rate'])
+        selector.register(client.read_fd, selectors.EVENT_READ, client)
+        remaining_request_count = 0
+        first_start_time = report_time = time.perf_counter()
+        with pinned(affinity.get('download')):
+            client.start()
+    total_bytes = 0
+
+    progress_monitor = None
+    if OPTIONS['dashboard']:
+        progress_monitor = ProgressMonitor(workdir, {'cache': cache_pid, 'proxy': proxy_pid}, client)
+        progress_monitor.start()
 
-            actual_request_count = min(MAX_GFCLIENT_DOWNLOAD_REQUEST_COUNT, remaining_request_count)
-
-            popen_download = subprocess.Popen([
-                './gfclient_download',
-                '-p',
-                str(port),
-                '-t',
-                str(download_thread_count),
-                '-w',
-                f'./{WORKLOAD_FILENAME}',
-                '-r',
-                str(actual_request_count)
-            ], cwd=workdir
-            )
+    while True:
+        # Keep every download slot busy until all the requests are handed out.
+        while free_indexes and remaining_request_count:
+            actual_request_count = min(batch_size, remaining_request_count)
+            index = free_indexes.pop(0)
+            cwd = download_dir(workdir, index)
+
+            # Time from just before the spawn to the moment the exit is seen.
+            start_time = time.perf_counter()
+            with pinned(affinity.get('download')):
+                popen_download = subprocess.Popen([
+                    './gfclient_download',
+                    '-p',
+                    str(port),
+                    '-t',
+                    str(download_thread_count),
+                    '-w',
+                    f'./{WORKLOAD_FILENAME}',
+                    '-r',
+                    str(actual_request_count)
+                ], cwd=cwd
+                )
+            # print(f'download pid: {popen_download.pid}')
+            watch_process(selector, popen_download)
+            downloads[popen_download] = (index, start_time, actual_request_count)
             remaining_request_count -= actual_request_count
-            start_time = time.time()
-
-        cache_poll = popen_cache.poll() 
+            if first_start_time is None:
+                first_start_time = report_time = start_time
+
+        if not downloads and not (client and actual_request_done < request_count):
+            break
+
+        # Sleep until one or more of the processes exit, or the client completes a batch.
+        for key, _ in selector.select():
+            if key.data is client:
+                os.read(key.fd, 1)
+                start_time, end_time, actual_request_count, batch_bytes = client.batches.get()
+            elif key.data in downloads:
+                end_time = time.perf_counter()
+                selector.unregister(key.fd)
+                os.close(key.fd)
+                key.data.wait()
+                index, start_time, actual_request_count = downloads.pop(key.data)
+                free_indexes.append(index)
+                # Each gfclient_download starts from the top of the workload file.
+                batch_bytes = expected_bytes(actual_request_count)
+            else:
+                continue
+            batch_count += 1
+            total_bytes += batch_bytes
+
+            elapsed_time = end_time - start_time
+
+            # Requests per second
+            rps = actual_request_count / elapsed_time
+            actual_request_done += actual_request_count
+
+            # CPU time (user and system), since the last report.
+            cache_utime, cache_stime = read_cpu_times(cache_pid)
+            proxy_utime, proxy_stime = read_cpu_times(proxy_pid)
+            elapsed_cache_utime = (cache_utime - start_cache_utime) / ticks_per_second
+            elapsed_cache_stime = (cache_stime - start_cache_stime) / ticks_per_second
+            elapsed_proxy_utime = (proxy_utime - start_proxy_utime) / ticks_per_second
+            elapsed_proxy_stime = (proxy_stime - start_proxy_stime) / ticks_per_second
+            (start_cache_utime, start_cache_stime) = (cache_utime, cache_stime)
+            (start_proxy_utime, start_proxy_stime) = (proxy_utime, proxy_stime)
+
+            # For the summary:
+            total_elapsed_cache_utime += elapsed_cache_utime
+            total_elapsed_cache_stime += elapsed_cache_stime
+            total_elapsed_proxy_utime += elapsed_proxy_utime
+            total_elapsed_proxy_stime += elapsed_proxy_stime
+
+            if ipc_monitor:
+                ipc_monitor.requests_done = actual_request_done
+
+            # CPU use is over the wall time since the last report, as downloads may overlap.
+            report_elapsed_time = end_time - report_time
+            report_time = end_time
+            results['batches'].append(print_benchmark(
+                f'{actual_request_done}/{request_count} in',
+                elapsed_time,
+                rps,
+                actual_request_count,
+                [elapsed_cache_utime, elapsed_cache_stime, elapsed_proxy_utime, elapsed_proxy_stime],
+                report_elapsed_time,
+                batch_bytes
+            ))
+
+        cache_poll = popen_cache.poll()
         proxy_poll = popen_proxy.poll()
 
+        if (cache_poll is not None) or (proxy_poll is not None):
+            close_watches(selector)
+            for popen_download in downloads:
+                popen_download.terminate()
+            if live_verifier:
+                live_verifier.stop()
+            if sampler:
+                sampler.stop()
+            if progress_monitor:
+                progress_monitor.stop()
+            if client:
+                client.stop()
+            if ipc_monitor:
+                ipc_monitor.stop()
         if (cache_poll is not None) and (proxy_poll is not None):
             print(f'Both cache exited ({cache_poll}) and proxy ({proxy_poll}) exited')
-            popen_download.terminate()
             return 3
         if cache_poll is not None:
             print(f'Cache exited ({cache_poll})')
-            popen_download.terminate()
-            popen_proxy.terminate()
+            terminate(popen_proxy, proxy_pid)
             return 1
         if proxy_poll is not None:
             print(f'Proxy exited ({proxy_poll})')
-            popen_download.terminate()
-            popen_cache.terminate()
+            terminate(popen_cache, cache_pid)
             return 2
 
-        time.sleep(1)
-
-    popen_cache.terminate()
-    popen_proxy.terminate()
+    if sampler:
+        sampler.stop()
+    if progress_monitor:
+        progress_monitor.stop()
+    if client:
+        client.join()
+        client.print_latency()
+
+    terminate(popen_cache, cache_pid)
+    terminate(popen_proxy, proxy_pid)
+    close_watches(selector)
+
+    if ipc_monitor:
+        ipc_monitor.stop()
+    if ipc_monitor or OPTIONS['profile']:
+        # Give the cache and proxy time to clean up on SIGTERM, and the profilers to write their output.
+        for popen in (popen_cache, popen_proxy):
+            try:
+                popen.wait(timeout=PROFILE_EXIT_TIMEOUT if OPTIONS['profile'] else 5)
+            except subprocess.TimeoutExpired:
+                print(f'{popen.args[0]} did not exit after SIGTERM')
+
+    ipc_cleaned_up = True
+    if ipc_monitor:
+        ipc_cleaned_up = ipc_monitor.check_cleanup()
+
+    if OPTIONS['profile'] == 'record':
+        for output in profile_outputs:
+            fold_perf_record(output)
+    if OPTIONS['profile']:
+        print(f'Profiles: {", ".join(profile_outputs)}')
+
+    if live_verifier:
+        live_verifier.stop()
 
     # Benchmark for this run, if it ran more than once
-    if total_elapsed_time > elapsed_time:
+    if batch_count > 1:
+        total_elapsed_time = report_time - first_start_time
         rps = actual_request_done / total_elapsed_time
-        total_elapsed_cache_ttime = total_elapsed_cache_utime + total_elapsed_cache_stime
-        total_elapsed_proxy_ttime = total_elapsed_proxy_utime + total_elapsed_proxy_stime
+        results['summary'] = print_benchmark(
+            'Summary:',
+            total_elapsed_time,
+            rps,
+            actual_request_done,
+            [total_elapsed_cache_utime, total_elapsed_cache_stime, total_elapsed_proxy_utime, total_elapsed_proxy_stime],
+            total_elapsed_time,
+            total_bytes
+        )
+    else:
+        results['summary'] = results['batches'][0]
 
-        request_count_chunk, request_count_extra = divmod(actual_request_done, len(WORKLOAD_SIZES))
-        if not request_count_extra:
-            nbytes = request_count_chunk * sum(WORKLOAD_SIZES)
-            bps = nbytes / total_elapsed_time
-            print(
-                f'Summary: {total_elapsed_time:0.2f}s, {rps:0.2f} rps, {bps:0.0f} bps, ',
-                end=''
-            )
-        else:
-            print(
-                f'Summary: {total_elapsed_time:0.2f}s, {rps:0.2f} rps, ',
-                end=''
-            )
+    if live_verifier and not live_verifier.success:
+        return 4
 
-        print(
-            'cache: '
-            f'{total_elapsed_cache_utime}s {100 * total_elapsed_cache_utime / total_elapsed_time:0.2f}% user, '
-            f'{total_elapsed_cache_stime}s {100 * total_elapsed_cache_stime / total_elapsed_time:0.2f}% kernel, '
-            f'{total_elapsed_cache_ttime}s {100 * total_elapsed_cache_ttime / total_elapsed_time:0.2f}% total, '
-            'proxy: '
-            f'{total_elapsed_proxy_utime}s {100 * total_elapsed_proxy_utime / total_elapsed_time:0.2f}% user, '
-            f'{total_elapsed_proxy_stime}s {100 * total_elapsed_proxy_stime / total_elapsed_time:0.2f}% kernel, '
-            f'{total_elapsed_proxy_ttime}s {100 * total_elapsed_proxy_ttime / total_elapsed_time:0.2f}% total'
-        )
+    if not ipc_cleaned_up:
+        return 5
 
+    if client and not client.success:
+        return 6
 
     return 0
 
 
-def verify_results(workdir: str) -> str:
-    """ Verify results, return True on success. """
-    filenames = glob.glob(f'{workdir}/{WORKLOAD_URL_PATH}/*')
-    result_filename = f'{workdir}/{WORKLOAD_URL_PATH}/sha1sum-result.txt'
-    run_sha1sum(filenames, result_filename)
+def hash_file(filename: str) -> str:
+    """ SHA1 hash of a file, read through a memory map. Only for files nothing is writing. """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        # Empty files cannot be mapped.
+        if os.fstat(file.fileno()).st_size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                sha1.update(mapped)
+    return sha1.hexdigest()
+
+
+def hash_file_read(filename: str) -> str:
+    """ SHA1 hash of a file, read in pieces. For files that may be truncated while hashing,
+    where a memory map would raise SIGBUS and kill the run. """
+    sha1 = hashlib.sha1()
+    buffer = bytearray(WORKLOAD_WRITE_SIZE)
+    view = memoryview(buffer)
+    with open(filename, 'rb', buffering=0) as file:
+        while n := file.readinto(buffer):
+            sha1.update(view[:n])
+    return sha1.hexdigest()
 
+
+def load_workload_hashes(workdir: str) -> dict:
+    """ Load the original hashes, keyed by file name. """
     # Entries in the sha1sum files are full paths.
     re_sha1sum = re.compile(r'(\w+)\s+(.*)')
 
-    # Load the original hashes for comparison.
     workload_sha1 = {}
     with open(f'{workdir}/{WORKLOAD_LOCAL_PATH}/sha1sum.txt', 'r') as file:
         for line in file:
             match = re_sha1sum.match(line.rstrip())
             if match:
                 workload_sha1[os.path.basename(match.group(2))] = match.group(1)
+    return workload_sha1
+
 
-    # Find all the mismatching hashes.
+def verify_results(workdir: str) -> bool:
+    """ Verify results, return True on success. """
+    filenames = [filename for path in result_paths(workdir) for filename in glob.glob(f'{path}/*')]
+    workload_sha1 = load_workload_hashes(workdir)
+
+    # Find all the mismatching hashes, hashing in parallel as the mapped pages come in.
     success = True
-    with open(result_filename, 'r') as file:
-        for line in file:
-            match = re_sha1sum.match(line.rstrip())
-            if match:
-                filename = os.path.basename(match.group(2))
-                workload_hash = workload_sha1.get(filename)
-                if workload_hash and (workload_hash != match.group(1)):
-                    print(f'Hash mismatch: {filename}')
-                    success = False
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for filename, sha1 in zip(filenames, executor.map(hash_file, filenames)):
+            filename = os.path.basename(filename)
+            workload_hash = workload_sha1.get(filename)
+            if workload_hash and (workload_hash != sha1):
+                print(f'Hash mismatch: {filename}')
+                success = False
 
     return success
 
 
+class LiveVerifier(threading.Thread):
+    """ Verify downloaded files while gfclient_download is still running. """
+
+    def __init__(self, workdir: str):
+        super().__init__(daemon=True)
+        self.workdir = workdir
+        self.workload_sha1 = load_workload_hashes(workdir)
+        self.workload_sizes = load_workload_sizes(workdir)
+        self.stop_event = threading.Event()
+        self.success = True
+
+    def run(self):
+        # Files are rewritten by every request for them, so track the (size, mtime) last seen.
+        seen = {}
+        verified = {}
+        while not self.stop_event.wait(LIVE_VERIFY_INTERVAL):
+            for path in result_paths(self.workdir):
+                for filename, expected_size in self.workload_sizes.items():
+                    self.check(f'{path}/{filename}', expected_size, seen, verified)
+
+    def check(self, full_filename: str, expected_size: int, seen: dict, verified: dict):
+        """ Hash the file if it is complete and has not changed since the last look. """
+        try:
+            stat = os.stat(full_filename)
+        except FileNotFoundError:
+            return
+        version = (stat.st_size, stat.st_mtime_ns)
+
+        if seen.get(full_filename) != version:
+            seen[full_filename] = version
+            return
+        if stat.st_size != expected_size or verified.get(full_filename) == version:
+            return
+
+        # gfclient_download may be rewriting the file, so no memory map.
+        sha1 = hash_file_read(full_filename)
+        stat = os.stat(full_filename)
+        if (stat.st_size, stat.st_mtime_ns) != version:
+            # Rewritten while hashing, look again next time.
+            return
+        verified[full_filename] = version
+        filename = os.path.basename(full_filename)
+        if sha1 != self.workload_sha1.get(filename):
+            print(f'Hash mismatch (live): {full_filename}')
+            self.success = False
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+def calibration_producer(
+    names: List[str],
+    lengths,
+    empty,
+    full,
+    sizes: Tuple[int, ...],
+    segment_size: int
+) -> None:
+    """ Cache side: copy each payload into the next free segment, a segment at a time. """
+    segments = [shared_memory.SharedMemory(name=name) for name in names]
+    payload = memoryview(os.urandom(max(sizes)))
+    slot = 0
+    for i in range(CALIBRATION_CYCLE_COUNT * len(sizes)):
+        size = sizes[i % len(sizes)]
+        offset = 0
+        # An empty payload still takes one empty segment, like an empty file.
+        while offset < size or not size:
+            length = min(segment_size, size - offset)
+            empty.acquire()
+            segments[slot].buf[:length] = payload[offset:offset + length]
+            lengths[slot] = length
+            full.release()
+            slot = (slot + 1) % len(segments)
+            offset += length
+            if not size:
+                break
+    for segment in segments:
+        segment.close()
+
+
+def calibration_consumer(names: List[str], lengths, empty, full, sizes: Tuple[int, ...]) -> None:
+    """ Proxy side: copy each segment out, as if to the client socket, then hand it back. """
+    segments = [shared_memory.SharedMemory(name=name) for name in names]
+    buffer = bytearray(max(sizes))
+    slot = 0
+    for i in range(CALIBRATION_CYCLE_COUNT * len(sizes)):
+        size = sizes[i % len(sizes)]
+        received = 0
+        while received < size or not size:
+            full.acquire()
+            length = lengths[slot]
+            buffer[received:received + length] = segments[slot].buf[:length]
+            empty.release()
+            slot = (slot + 1) % len(segments)
+            received += length
+            if not size:
+                break
+    for segment in segments:
+        segment.close()
+
+
+@functools.lru_cache(maxsize=None)
+def ipc_ceiling(segment_count: int, segment_size: int, sizes: Tuple[int, ...]) -> Tuple[float, float]:
+    """ Requests and bytes per second a producer and consumer can move through
+    segment_count shared memory segments of segment_size, with semaphore handoff,
+    for requests of the workload file's sizes. """
+    segments = [shared_memory.SharedMemory(create=True, size=segment_size) for _ in range(segment_count)]
+    names = [segment.name for segment in segments]
+    lengths = multiprocessing.Array('q', segment_count, lock=False)
+    empty = multiprocessing.Semaphore(segment_count)
+    full = multiprocessing.Semaphore(0)
+
+    processes = [
+        multiprocessing.Process(
+            target=calibration_producer,
+            args=(names, lengths, empty, full, sizes, segment_size)),
+        multiprocessing.Process(
+            target=calibration_consumer,
+            args=(names, lengths, empty, full, sizes)),
+    ]
+    start_time = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed_time = time.perf_counter() - start_time
+
+    for segment in segments:
+        segment.close()
+        segment.unlink()
+
+    nbytes = CALIBRATION_CYCLE_COUNT * sum(sizes)
+    rps = CALIBRATION_CYCLE_COUNT * len(sizes) / elapsed_time
+    bps = nbytes / elapsed_time
+    print(f'IPC ceiling for {segment_count} segments of {segment_size}: {rps:0.2f} rps, {bps:0.0f} bps')
+    return rps, bps
+
+
+def git_revision(workdir: str) -> str:
+    """ Git revision of the project in workdir, with -dirty if it has changes. """
+    result = subprocess.run(['git', '-C', workdir, 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True)
+    if result.returncode:
+        return 'unknown'
+    status = subprocess.run(
+        ['git', '-C', workdir, 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True)
+    return result.stdout.strip() + ('-dirty' if status.stdout.strip() else '')
+
+
+class ResultStore:
+    """ SQLite store of every run, tagged with the git revision and host, for the compare test. """
+
+    def __init__(self, workdir: str, test_name: str):
+        filename = f'{workdir}/{RESULTS_DB_FILENAME}'
+        # Sweeps store runs from several threads.
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(RESULTS_SCHEMA)
+            for table, columns in RESULTS_ADDED_COLUMNS.items():
+                existing = {row[1] for row in self.connection.execute(f'PRAGMA table_info({table})')}
+                for name, definition in columns.items():
+                    if name not in existing:
+                        self.connection.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+            self.session_id = self.connection.execute(
+                'INSERT INTO sessions (started, test, revision, host, options) VALUES (?, ?, ?, ?, ?)',
+                (time.strftime('%Y-%m-%d %H:%M:%S'), test_name, git_revision(workdir), socket.gethostname(),
+                 json.dumps(OPTIONS))
+            ).lastrowid
+        print(f'Storing results as session {self.session_id} in {filename}')
+
+    def add_run(
+        self,
+        config: dict,
+        storage: str,
+        trial: int,
+        exit_code: int,
+        verified: bool,
+        results: dict
+    ) -> None:
+        # A run that failed part way has batches but no summary.
+        summary = results.get('summary', {})
+        run_columns = ['session_id', 'storage', 'trial', 'exit_code', 'verified'] + CONFIG_FIELDS + SUMMARY_FIELDS
+        run_values = [self.session_id, storage, trial, exit_code, verified] + \
+            [config[field] for field in CONFIG_FIELDS] + [summary.get(field) for field in SUMMARY_FIELDS]
+        batch_columns = ['run_id', 'batch'] + BENCHMARK_FIELDS
+
+        with self.lock, self.connection:
+            run_id = self.connection.execute(
+                f'INSERT INTO runs ({", ".join(run_columns)}) VALUES ({", ".join("?" * len(run_columns))})',
+                run_values
+            ).lastrowid
+            self.connection.executemany(
+                f'INSERT INTO batches ({", ".join(batch_columns)}) VALUES ({", ".join("?" * len(batch_columns))})',
+                [[run_id, i] + [batch[field] for field in BENCHMARK_FIELDS] for i, batch in enumerate(results['batches'])]
+            )
+
+
+# Set in main, unless --store=0.
+result_store: Optional[ResultStore] = None
+
+
+def run_and_verify(
+    workdir: str,
+    cache_thread_count: int,
+    proxy_thread_count: int,
+    proxy_segment_count: int,
+    proxy_segment_size: int,
+    download_thread_count: int,
+    request_count: int,
+    port: int,
+    core_count: Optional[int] = None,
+    summaries: Optional[list] = None
+) -> Optional[float]:
+    """ Run IPC Stress and verify the results, for each trial. Return the mean rps, or None on failure.
+    With a placement, the cache and proxy are pinned to core_count cores, default all of them.
+    If summaries is given, the summary of each trial is appended to it. """
+    affinity = placement_cpus(OPTIONS['placement'], core_count)
+    config = {
+        'cache_thread_count': cache_thread_count,
+        'proxy_thread_count': proxy_thread_count,
+        'proxy_segment_count': proxy_segment_count,
+        'proxy_segment_size': proxy_segment_size,
+        'download_thread_count': download_thread_count,
+        'request_count': request_count,
+        'downloads': OPTIONS['downloads'],
+        # Cores the cache and proxy are pinned to, 0 if not pinned.
+        'cores': 0 if affinity is None else core_count or len(physical_cores()),
+    }
+
+    # Measured before this configuration's runs. A sweep measures every configuration before
+    # starting any of its jobs, so this is then cached and no other job's runs overlap it.
+    if OPTIONS['calibrate']:
+        ceiling_rps, ceiling_bps = ipc_ceiling(proxy_segment_count, proxy_segment_size, tuple(request_sizes))
+
+    rps = []
+    for trial in range(OPTIONS['trials']):
+        print(
+            f'cache_thread_count={cache_thread_count}, proxy_thread_count={proxy_thread_count}, '
+            f'proxy_segment_count={proxy_segment_count}, proxy_segment_size={proxy_segment_size}, '
+            f'download_thread_count={download_thread_count}, request_count={request_count}' +
+            (f', cores={config["cores"]}' if affinity else '') + '\n',
+            end=''
+        )
+        results = {}
+        exit_code = run_ipcstress(
+            workdir,
+            cache_thread_count,
+            proxy_thread_count,
+            proxy_segment_count,
+            proxy_segment_size,
+            download_thread_count,
+            request_count,
+            port,
+            results,
+            affinity
+        )
+        verified = exit_code == 0 and verify_results(workdir)
+        if result_store:
+            result_store.add_run(config, storage_backend(workdir), trial, exit_code, verified, results)
+        if not verified:
+            return None
+        rps.append(results['summary']['rps'])
+        if summaries is not None:
+            summaries.append(results['summary'])
+
+        if OPTIONS['calibrate']:
+            summary = results['summary']
+            print(
+                f'Efficiency: {100 * summary["rps"] / ceiling_rps:0.2f}% of the IPC ceiling rps, '
+                f'{100 * summary["bps"] / ceiling_bps:0.2f}% of the IPC ceiling bps'
+            )
+
+    return statistics.mean(rps)
+
+
 def run_base_test(workdir: str):
     """ Base level of testing. """
 
@@ -362,12 +1913,7 @@ def run_base_test(workdir: str):
     proxy_segment_size = 1024
     download_thread_count = 1
 
-    print(
-        f'cache_thread_count={cache_thread_count}, proxy_thread_count={proxy_thread_count}, '
-        f'proxy_segment_count={proxy_segment_count}, proxy_segment_size={proxy_segment_size}, '
-        f'download_thread_count={download_thread_count}, request_count={request_count}'
-    )
-    if run_ipcstress(
+    run_and_verify(
         workdir,
         cache_thread_count,
         proxy_thread_count,
@@ -376,49 +1922,144 @@ def run_base_test(workdir: str):
         download_thread_count,
         request_count,
         port
-    ) != 0:
-        return
+    )
+
+
+def sweep_dir(workdir: str, slot: int) -> str:
+    """ Directory for configurations run in a sweep slot, linking to the binaries and workload. """
+    path = f'{workdir}/{SWEEP_DIR_PREFIX}{slot}'
+    os.makedirs(path, exist_ok=True)
+    for filename in ['simplecached', 'webproxy', 'gfclient_download', LOCALS_FILENAME, WORKLOAD_FILENAME, WORKLOAD_LOCAL_PATH]:
+        if not os.path.lexists(f'{path}/{filename}'):
+            os.symlink(os.path.abspath(f'{workdir}/{filename}'), f'{path}/{filename}')
+    return path
+
+
+def format_config(config: Tuple[int, ...]) -> str:
+    return ', '.join(f'{name}={value}' for name, value in zip(PARAMETER_GRID, config))
+
+
+def run_configuration(workdir: str, slots: queue.Queue, config: Tuple[int, ...], request_count: int) -> Optional[float]:
+    """ Run one configuration in a free sweep slot. Return its mean rps, or None if it failed. """
+    cache_thread_count, proxy_thread_count, proxy_segment_count, proxy_segment_size = config
+    download_thread_count = proxy_thread_count
+
+    slot = slots.get()
+    try:
+        return run_and_verify(
+            sweep_dir(workdir, slot),
+            cache_thread_count,
+            proxy_thread_count,
+            proxy_segment_count,
+            proxy_segment_size,
+            download_thread_count,
+            request_count,
+            SWEEP_BASE_PORT + slot
+        )
+    finally:
+        slots.put(slot)
+
+
+def run_sweep(workdir: str, configs: List[Tuple[int, ...]], request_count: int) -> dict:
+    """ Run configurations in parallel, return their rps. Stop at the first failure. """
+    jobs = OPTIONS['jobs'] or max(1, len(os.sched_getaffinity(0)) // 3)
+    # The IPC monitor sees every IPC resource on the host: POSIX names and System V semaphores
+    # have no creator pid, so the resources of parallel runs cannot be told apart.
+    if OPTIONS['ipc-monitor'] and jobs > 1:
+        if OPTIONS['jobs']:
+            sys.exit('--ipc-monitor cannot tell parallel runs apart, use --jobs=1')
+        jobs = 1
+    slots = queue.Queue()
+    for slot in range(jobs):
+        slots.put(slot)
+
+    # Calibrate before any job starts, so the other jobs' runs do not compete with the calibration.
+    if OPTIONS['calibrate']:
+        for proxy_segment_count, proxy_segment_size in sorted({config[2:4] for config in configs}):
+            ipc_ceiling(proxy_segment_count, proxy_segment_size, tuple(request_sizes))
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = {
+            executor.submit(run_configuration, workdir, slots, config, request_count): config
+            for config in configs
+        }
+        for future in concurrent.futures.as_completed(futures):
+            config = futures[future]
+            results[config] = future.result()
+            if results[config] is None:
+                print(f'Failed: {format_config(config)}')
+                executor.shutdown(cancel_futures=True)
+                break
+            print(f'Result: {format_config(config)}: {results[config]:0.2f} rps')
+
+    return results
+
+
+def print_best(results: dict, count: int = 5) -> None:
+    """ Show the configurations with the highest rps. """
+    measured = [(rps, config) for config, rps in results.items() if rps is not None]
+    for rps, config in sorted(measured, reverse=True)[:count]:
+        print(f'Best: {format_config(config)}: {rps:0.2f} rps')
 
-    if not verify_results(workdir):
-        return
+
+def run_adaptive_sweep(workdir: str, request_count: int) -> dict:
+    """ Run a coarse grid, then hill-climb from its best configuration one step at a time. """
+    grid = list(PARAMETER_GRID.values())
+
+    def to_config(indexes: Tuple[int, ...]) -> Tuple[int, ...]:
+        return tuple(values[index] for values, index in zip(grid, indexes))
+
+    def is_valid(indexes: Tuple[int, ...]) -> bool:
+        return all(0 <= index < len(values) for values, index in zip(grid, indexes)) and indexes[1] >= indexes[0]
+
+    results = {}
+
+    def measure(candidates: List[Tuple[int, ...]]) -> bool:
+        configs = [to_config(indexes) for indexes in candidates if to_config(indexes) not in results]
+        results.update(run_sweep(workdir, configs, request_count))
+        return None not in results.values()
+
+    coarse = [
+        indexes for indexes in itertools.product(*[range(0, len(values), SWEEP_COARSE_STEP) for values in grid])
+        if is_valid(indexes)
+    ]
+    if not measure(coarse):
+        return results
+
+    best = max(coarse, key=lambda indexes: results[to_config(indexes)])
+    while True:
+        neighbours = []
+        for dimension, step in itertools.product(range(len(grid)), (-1, 1)):
+            indexes = list(best)
+            indexes[dimension] += step
+            if is_valid(tuple(indexes)):
+                neighbours.append(tuple(indexes))
+        if not measure(neighbours):
+            return results
+
+        candidate = max(neighbours + [best], key=lambda indexes: results[to_config(indexes)])
+        if candidate == best:
+            return results
+        best = candidate
 
 
 def run_parameter_test(workdir: str):
-    """ Test through a wide range of parameters. """
+    """ Test through a wide range of parameters, several configurations at once. """
 
-    port = 10823
     create_workload(workdir)
 
     request_count = 10
-    for cache_thread_count in range(1, 101, 10):
-        for proxy_thread_count in range(cache_thread_count, 101, 10):
-            for proxy_segment_count in range(1, 101, 10):
-                download_thread_count = proxy_thread_count
-
-                proxy_segment_size = MIN_SEG_SIZE
-                while proxy_segment_size <= 1048576:
-                    print(
-                        f'cache_thread_count={cache_thread_count}, proxy_thread_count={proxy_thread_count}, '
-                        f'proxy_segment_count={proxy_segment_count}, proxy_segment_size={proxy_segment_size}, '
-                        f'download_thread_count={download_thread_count}, request_count={request_count}'
-                    )
-
-                    if run_ipcstress(
-                        workdir,
-                        cache_thread_count,
-                        proxy_thread_count,
-                        proxy_segment_count,
-                        proxy_segment_size,
-                        download_thread_count,
-                        request_count,
-                        port
-                    ) != 0:
-                        return
-
-                    if not verify_results(workdir):
-                        return
-
-                    proxy_segment_size *= 4
+    if OPTIONS['sweep'] == 'adaptive':
+        results = run_adaptive_sweep(workdir, request_count)
+    else:
+        configs = [
+            config for config in itertools.product(*PARAMETER_GRID.values())
+            if config[1] >= config[0]
+        ]
+        results = run_sweep(workdir, configs, request_count)
+
+    print_best(results)
 
 
 def run_stress_test(workdir: str):
@@ -435,13 +2076,7 @@ def run_stress_test(workdir: str):
         for proxy_thread_count in range(cache_thread_count, 101, 10):
             download_thread_count = proxy_thread_count
 
-            print(
-                f'cache_thread_count={cache_thread_count}, proxy_thread_count={proxy_thread_count}, '
-                f'proxy_segment_count={proxy_segment_count}, proxy_segment_size={proxy_segment_size}, '
-                f'download_thread_count={download_thread_count}, request_count={request_count}'
-            )
-
-            if run_ipcstress(
+            if run_and_verify(
                 workdir,
                 cache_thread_count,
                 proxy_thread_count,
@@ -450,10 +2085,7 @@ def run_stress_test(workdir: str):
                 download_thread_count,
                 request_count,
                 port
-            ) != 0:
-                return
-
-            if not verify_results(workdir):
+            ) is None:
                 return
 
 def run_soak_test(workdir: str):
@@ -470,13 +2102,7 @@ def run_soak_test(workdir: str):
     proxy_thread_count = 100
     download_thread_count = proxy_thread_count
 
-    print(
-        f'cache_thread_count={cache_thread_count}, proxy_thread_count={proxy_thread_count}, '
-        f'proxy_segment_count={proxy_segment_count}, proxy_segment_size={proxy_segment_size}, '
-        f'download_thread_count={download_thread_count}, request_count={request_count}'
-    )
-
-    if run_ipcstress(
+    run_and_verify(
         workdir,
         cache_thread_count,
         proxy_thread_count,
@@ -485,11 +2111,179 @@ def run_soak_test(workdir: str):
         download_thread_count,
         request_count,
         port
-    ) != 0:
-        return
+    )
+
+
+def run_scaling_test(workdir: str):
+    """ Run fixed thread counts on more and more cores, for the speedup and parallel efficiency. """
+
+    port = 10823
+    create_workload(workdir)
+
+    request_count = 1000
+    proxy_segment_count = 16
+    proxy_segment_size = 1048576
+
+    cache_thread_count = 16
+    proxy_thread_count = 16
+    download_thread_count = proxy_thread_count
+
+    if OPTIONS['placement'] == 'none':
+        OPTIONS['placement'] = 'same'
+
+    # Powers of two up to every core, from two for disjoint, which needs a core each.
+    available = len(physical_cores())
+    first = 2 if OPTIONS['placement'] == 'disjoint' else 1
+    core_counts = sorted({min(first << i, available) for i in range(available.bit_length() + 1)})
+
+    scaling = []
+    for core_count in core_counts:
+        summaries = []
+        rps = run_and_verify(
+            workdir,
+            cache_thread_count,
+            proxy_thread_count,
+            proxy_segment_count,
+            proxy_segment_size,
+            download_thread_count,
+            request_count,
+            port,
+            core_count,
+            summaries
+        )
+        if rps is None:
+            break
+        scaling.append((core_count, rps, summaries))
 
-    if not verify_results(workdir):
+    if not scaling:
         return
+    print(f'Scaling with {OPTIONS["placement"]} placement:')
+    base_core_count, base_rps, _ = scaling[0]
+    for core_count, rps, summaries in scaling:
+        speedup = rps / base_rps
+        efficiency = 100 * speedup * base_core_count / core_count
+        print(
+            f'{core_count} cores: {rps:0.2f} rps, speedup {speedup:0.2f}, efficiency {efficiency:0.1f}%, ' +
+            ', '.join(
+                f'{name} {statistics.mean(summary[field] for summary in summaries):0.2f}%'
+                for name, field in [
+                    ('cache user', 'cache_user_percent'), ('cache kernel', 'cache_kernel_percent'),
+                    ('proxy user', 'proxy_user_percent'), ('proxy kernel', 'proxy_kernel_percent'),
+                ]
+            )
+        )
+
+
+def run_calibrate_test(workdir: str):
+    """ Measure the shared memory ceiling for the segment counts and sizes the tests use. """
+    sizes = tuple(workload_request_sizes())
+    for proxy_segment_count in [1, 10, 50]:
+        for proxy_segment_size in PARAMETER_GRID['proxy_segment_size'] + [1024, 1048576]:
+            ipc_ceiling(proxy_segment_count, proxy_segment_size, sizes)
+
+
+def t_critical(df: float) -> float:
+    """ Two-sided 95% t critical value, rounding df down to the table. """
+    return T_CRITICAL_95[max([key for key in T_CRITICAL_95 if key <= df], default=1)]
+
+
+def mean_interval(values: List[float]) -> Tuple[float, float]:
+    """ Mean and half width of its 95% confidence interval, nan with a single trial. """
+    if len(values) < 2:
+        return values[0], math.nan
+    return statistics.mean(values), t_critical(len(values) - 1) * statistics.stdev(values) / math.sqrt(len(values))
+
+
+def is_significant(baseline: List[float], candidate: List[float]) -> bool:
+    """ Welch's t-test for a difference in means at 95%. """
+    if len(baseline) < 2 or len(candidate) < 2:
+        return False
+    baseline_var = statistics.variance(baseline) / len(baseline)
+    candidate_var = statistics.variance(candidate) / len(candidate)
+    difference = statistics.mean(candidate) - statistics.mean(baseline)
+    if baseline_var + candidate_var == 0:
+        return difference != 0
+    t = difference / math.sqrt(baseline_var + candidate_var)
+    df = (baseline_var + candidate_var) ** 2 / (
+        baseline_var ** 2 / (len(baseline) - 1) + candidate_var ** 2 / (len(candidate) - 1))
+    return abs(t) > t_critical(df)
+
+
+def run_compare_test(workdir: str):
+    """ Compare the rps of each configuration between two stored sessions. """
+    filename = f'{workdir}/{RESULTS_DB_FILENAME}'
+    if not os.path.exists(filename):
+        sys.exit(f'No stored results in {filename}')
+    connection = sqlite3.connect(filename)
+    if not connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sessions'").fetchone():
+        sys.exit(f'No sessions in {filename}')
+
+    latest = [row[0] for row in connection.execute('SELECT id FROM sessions ORDER BY id DESC LIMIT 2')]
+    candidate = OPTIONS['candidate'] or (latest[0] if latest else None)
+    # The latest session other than the candidate.
+    baseline = OPTIONS['baseline'] or next((session_id for session_id in latest if session_id != candidate), None)
+    if baseline is None or candidate is None or baseline == candidate:
+        sys.exit(f'Compare needs two different sessions, {len(latest)} stored in {filename}, '
+                 'or --baseline=ID different from --candidate=ID')
+
+    for session_id in (baseline, candidate):
+        session = connection.execute(
+            'SELECT started, test, revision, host FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        if session is None:
+            sys.exit(f'No session {session_id} in {filename}')
+        started, test, revision, host = session
+        storage = ', '.join(
+            row[0] or 'unknown'
+            for row in connection.execute('SELECT DISTINCT storage FROM runs WHERE session_id = ?', (session_id,))
+        )
+        print(f'Session {session_id}: {test} at {started}, revision {revision} on {host}, storage {storage}')
+
+    def load(session_id: int) -> dict:
+        rps = {}
+        for row in connection.execute(
+                f'SELECT {", ".join(CONFIG_FIELDS)}, rps FROM runs WHERE session_id = ? AND verified', (session_id,)):
+            rps.setdefault(row[:-1], []).append(row[-1])
+        return rps
+
+    baseline_rps = load(baseline)
+    candidate_rps = load(candidate)
+    regressions = 0
+    for config in sorted(baseline_rps.keys() & candidate_rps.keys()):
+        baseline_mean, baseline_interval = mean_interval(baseline_rps[config])
+        candidate_mean, candidate_interval = mean_interval(candidate_rps[config])
+        delta = 100 * (candidate_mean - baseline_mean) / baseline_mean
+        flag = ''
+        if is_significant(baseline_rps[config], candidate_rps[config]):
+            flag = ' REGRESSION' if delta < 0 else ' improvement'
+            regressions += delta < 0
+        print(
+            f'{", ".join(f"{name}={value}" for name, value in zip(CONFIG_FIELDS, config))}: '
+            f'{baseline_mean:0.2f} ± {baseline_interval:0.2f} rps (n={len(baseline_rps[config])}) -> '
+            f'{candidate_mean:0.2f} ± {candidate_interval:0.2f} rps (n={len(candidate_rps[config])}), '
+            f'{delta:+0.1f}%{flag}'
+        )
+    print(f'{regressions} significant regressions')
+
+
+def parse_options(args: List[str]) -> List[str]:
+    """ Set OPTIONS from --name or --name=value arguments, return the other arguments. """
+    positional = []
+    for arg in args:
+        if not arg.startswith('--'):
+            positional.append(arg)
+            continue
+
+        name, _, value = arg[2:].partition('=')
+        if name not in OPTIONS:
+            sys.exit(f'Unknown option: {arg}, options are {list(OPTIONS)}')
+        default = OPTIONS[name]
+        if isinstance(default, bool):
+            OPTIONS[name] = value.lower() not in ('0', 'false', 'no')
+        elif default is None:
+            OPTIONS[name] = value
+        else:
+            OPTIONS[name] = type(default)(value)
+    return positional
 
 
 if __name__ == '__main__':
@@ -498,8 +2292,18 @@ if __name__ == '__main__':
         if name.startswith('run_') and name.endswith("_test")
     ]
 
-    print(f'python3 {sys.argv[0]} workdir {test_names}')
-    workdir = sys.argv[1] if len(sys.argv) >= 2 else '.'
-    test_name = sys.argv[2] if len(sys.argv) >= 3 else 'base'
-
-    (globals()[f'run_{test_name}_test'])(workdir)
+    print(f'python3 {sys.argv[0]} workdir {test_names} {["--" + name for name in OPTIONS]}')
+    args = parse_options(sys.argv[1:])
+    workdir = args[0] if len(args) >= 1 else '.'
+    test_name = args[1] if len(args) >= 2 else 'base'
+
+    if OPTIONS['store'] and test_name != 'compare':
+        result_store = ResultStore(workdir, test_name)
+
+    # The results are stored in workdir, and the samples and profiles copied back to it.
+    run_workdir = stage_workdir(workdir) if OPTIONS['tmpfs'] and test_name != 'compare' else workdir
+    try:
+        (globals()[f'run_{test_name}_test'])(run_workdir)
+    finally:
+        if run_workdir != workdir:
+            unstage_workdir(run_workdir, workdir)